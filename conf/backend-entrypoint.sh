@@ -6,7 +6,12 @@ if [ "$RACK_ENV" != 'dev' ]; then
 
     [ -f "$PROJECT_SECRETS_FILE" ] \
     || ( echo "Specify the secrets.json path in the env variable PROJECT_SECRETS_FILE" ; exit 1 )
-    
+fi
+
+# only the app server prepares static files and the database,
+# other commands, e.g. the image worker, run in the same image
+if [ "$RACK_ENV" != 'dev' ] && [ "$1" = 'gunicorn' ]; then
+
     echo -e "\nCollect static files"
     ./manage.py collectstatic --no-input
 
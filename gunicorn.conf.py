@@ -0,0 +1,12 @@
+# the main thread of a gthread worker keeps notifying the arbiter while
+# a request streams a long response, such as an export, in another one
+worker_class = 'gthread'
+
+
+def post_worker_init(worker):
+    """Warms up the shop cache when a worker has loaded the application."""
+    from shop.cache import warm_up
+    try:
+        warm_up()
+    except Exception as exc:
+        worker.log.warning('Shop cache warm-up failed: %s', exc)
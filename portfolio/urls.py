@@ -3,10 +3,17 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from shop.services import DERIVATIVES_DIR
+from shop.views import ImageDerivativeView
+
 urlpatterns = [
     path('', include('mainapp.urls')),
     path('admin/', admin.site.urls),
-    path('shop/', include('shop.urls'))
+    path('shop/', include('shop.urls')),
+    # nginx serves existing derivatives from the media files
+    path(f'{settings.MEDIA_URL.lstrip("/")}{DERIVATIVES_DIR}/'
+         f'<path:name>/<int:width>.<str:fmt>',
+         ImageDerivativeView.as_view(), name='image_derivative'),
 ]
 
 if settings.DEBUG:
@@ -1,8 +1,11 @@
+from functools import partial
+
 from django.contrib import admin
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.admin import GenericStackedInline
+from django.db import transaction
 
-from . import models, forms
+from . import cache, models, forms
 
 
 class SpecificationInline(GenericStackedInline):
@@ -112,12 +115,13 @@ class OrderAdmin(admin.ModelAdmin):
         return f if obj.status < obj.SHIPPING else f + ['address']
 
     def save_related(self, request, form, formset, change):
-        """Calculates the order cost and reserves the quantity of items"""
+        """
+        Calculates the order cost and reserves the quantity of items,
+        invalidates the user cached cart once the changes are committed.
+        """
         super().save_related(request, form, formset, change)
-        if not change:
-            return
         order = form.instance
-        if order.status <= order.PROCESSING:
+        if change and order.status <= order.PROCESSING:
             qs = models.Order.objects.filter(id=order.id)
             kwargs = {'order_cost': form.get_current_cost()}
             if order.status == order.PROCESSING and not order.reserved:
@@ -125,8 +129,16 @@ class OrderAdmin(admin.ModelAdmin):
                 if order.reserve_available_quantity():
                     kwargs['reserved'] = True
                 else:
-                    kwargs['status'] = order.CART
+                    kwargs['status'] = order.status = order.CART
             qs.update(**kwargs)
+        if order.update_num_orders():
+            models.Order.objects.filter(id=order.id).update(
+                counted=order.counted,
+            )
+        if order.stock_changed:
+            order.stock_changed = False
+            transaction.on_commit(cache.invalidate_pages)
+        transaction.on_commit(partial(cache.invalidate_cart, order.user_id))
 
 
 @admin.register(models.Rate)
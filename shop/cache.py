@@ -0,0 +1,258 @@
+import hashlib
+import time
+from functools import lru_cache
+
+from django.core.cache import cache
+from django.contrib.postgres.search import SearchRank
+from django.db.models import F, Prefetch
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import urlencode
+
+from .models import (
+    Category, Order, OrderItem, SearchDocument, Specification,
+)
+
+
+CATALOG_KEY = 'shop:catalog'
+CATALOG_TIMEOUT = 60 * 60 * 24
+CART_KEY = 'shop:cart:{}'
+CART_TIMEOUT = 60 * 60 * 24
+SEARCH_KEY = 'shop:search'
+SEARCH_TIMEOUT = 60 * 15
+SUGGEST_TIMEOUT = 60
+FACETS_KEY = 'shop:facets:{}'
+FACETS_TIMEOUT = 60 * 10
+NEW_ARRIVALS_KEY = 'shop:new_arrivals'
+PAGE_KEY = 'shop:page'
+PAGE_TIMEOUT = 60 * 5
+PAGE_MODIFIED_KEY = 'shop:page:modified'
+SUGGEST_LIMIT = 8
+
+
+def get_version(key) -> int:
+    """
+    Returns the current version of cached data for the key.
+
+    The initial version is a timestamp, so a version evicted from
+    the cache is not reused for stale data.
+    """
+    version_key = f'{key}:version'
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, int(time.time()), timeout=None)
+        version = cache.get(version_key, 1)
+    return version
+
+
+def bump_version(key):
+    """Invalidates all cached data for the key by a new version."""
+    version_key = f'{key}:version'
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        cache.set(version_key, int(time.time()), timeout=None)
+
+
+def get_catalog() -> list:
+    """Returns cached parent categories with prefetched subcategories."""
+    version = get_version(CATALOG_KEY)
+    catalog = cache.get(CATALOG_KEY, version=version)
+    if catalog is None:
+        catalog = list(Category.objects.filter(
+            category__isnull=True,
+        ).prefetch_related(Prefetch('categories', to_attr='subcategories')))
+        cache.set(CATALOG_KEY, catalog, CATALOG_TIMEOUT, version=version)
+    return catalog
+
+
+def get_cart(user_id) -> dict:
+    """
+    Returns the user cart as a dict with a specification id as a key
+    and an item quantity as a value.
+    """
+    key = CART_KEY.format(user_id)
+    cart = cache.get(key)
+    if cart is None:
+        cart = dict(OrderItem.objects.filter(
+            order__user_id=user_id, order__status=Order.CART,
+        ).values_list('specification_id', 'quantity'))
+        cache.set(key, cart, CART_TIMEOUT)
+    return cart
+
+
+def set_cart_item(user_id, spec_id, quantity):
+    """Updates the item quantity in the cached cart, 0 removes it."""
+    cart = get_cart(user_id)
+    if quantity > 0:
+        cart[spec_id] = quantity
+    else:
+        cart.pop(spec_id, None)
+    cache.set(CART_KEY.format(user_id), cart, CART_TIMEOUT)
+
+
+def invalidate_cart(user_id):
+    cache.delete(CART_KEY.format(user_id))
+
+
+def normalize_search_terms(q: str) -> list:
+    """Returns unique lowercase terms of the search query in order."""
+    return sorted(set(q.lower().split()))
+
+
+def get_search_ids(terms, queryset) -> list:
+    """
+    Returns cached ids of specs found for the normalized search terms,
+    evaluates the ranked queryset if they are not cached.
+    """
+    digest = hashlib.md5(' '.join(terms).encode()).hexdigest()
+    key = f'{SEARCH_KEY}:{digest}'
+    version = get_version(SEARCH_KEY)
+    id_list = cache.get(key, version=version)
+    if id_list is None:
+        id_list = list(queryset.values_list('id', flat=True))
+        cache.set(key, id_list, SEARCH_TIMEOUT, version=version)
+    return id_list
+
+
+def get_suggestions(q: str) -> dict:
+    """
+    Returns categories and specs matching the typed text.
+
+    The hottest texts are kept in the process memory until
+    the search version is changed or SUGGEST_TIMEOUT expires.
+    """
+    text = ' '.join(q.lower().split())
+    period = int(time.time() // SUGGEST_TIMEOUT)
+    return _get_suggestions(text, get_version(SEARCH_KEY), period)
+
+
+@lru_cache(maxsize=1024)
+def _get_suggestions(text, version, period) -> dict:
+    query = SearchDocument.objects.get_prefix_query(text)
+    if query is None:
+        return {'categories': [], 'specs': []}
+    categories = Category.objects.filter(search_vector=query).annotate(
+        rank=SearchRank(F('search_vector'), query),
+    ).select_related('category').order_by('-rank', 'name')[:SUGGEST_LIMIT]
+    specs = SearchDocument.objects.suggest(text, limit=SUGGEST_LIMIT)
+    return {
+        'categories': [
+            {'text': c.name, 'url': c.get_absolute_url()} for c in categories
+        ],
+        'specs': [{
+            'text': s['title'],
+            'url': reverse('shop:spec_detail', kwargs={
+                'category': str(s['parent_category__name']).lower(),
+                'subcategory': str(s['category__name']).lower(),
+                'pk': s['specification_id'],
+            }),
+        } for s in specs],
+    }
+
+
+def get_facet_counts(category, price_limits) -> dict:
+    """
+    Returns cached facet counts of available specs in the category
+    and its subcategories.
+    """
+    key = FACETS_KEY.format(category.id)
+    version = get_version(key)
+    counts = cache.get(key, version=version)
+    if counts is None or counts['price_limits'] != list(price_limits):
+        category_ids = [category.id] + [
+            c.id for c in getattr(category, 'subcategories', ())
+        ]
+        counts = SearchDocument.objects.facet_counts(
+            category_ids, price_limits,
+        )
+        counts['price_limits'] = list(price_limits)
+        cache.set(key, counts, FACETS_TIMEOUT, version=version)
+    return counts
+
+
+def invalidate_facets(*category_ids):
+    """Invalidates facet counts of the categories and their parents."""
+    parent_ids = Category.objects.filter(
+        id__in=category_ids, category__isnull=False,
+    ).values_list('category_id', flat=True)
+    for category_id in {*category_ids, *parent_ids}:
+        bump_version(FACETS_KEY.format(category_id))
+
+
+def get_new_arrival_ids(category, since) -> list:
+    """
+    Returns cached ids of available specs added to the category and
+    its subcategories since the date.
+
+    Ids are kept until the end of the day when the window moves.
+    """
+    key = f'{NEW_ARRIVALS_KEY}:{category.id}:{since.isoformat()}'
+    version = get_version(NEW_ARRIVALS_KEY)
+    id_list = cache.get(key, version=version)
+    if id_list is None:
+        category_ids = [category.id] + [
+            c.id for c in getattr(category, 'subcategories', ())
+        ]
+        id_list = list(Specification.objects.filter(
+            category_id__in=category_ids, available_qty__gt=0,
+            date_added__gte=since,
+        ).values_list('id', flat=True))
+        now = timezone.localtime()
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        timeout = 60 * 60 * 24 - (now - midnight).seconds
+        cache.set(key, id_list, timeout, version=version)
+    return id_list
+
+
+def get_page_key(request) -> str:
+    """Returns a cache key of the page by its path and sorted query."""
+    query = urlencode(sorted(request.GET.lists()), doseq=True)
+    url = f'{request.path}?{query}'
+    return f'{PAGE_KEY}:{hashlib.md5(url.encode()).hexdigest()}'
+
+
+def get_page(request):
+    """Returns the cached content and content type of the page."""
+    return cache.get(get_page_key(request), version=get_version(PAGE_KEY))
+
+
+def set_page(request, response):
+    """Caches the rendered page until the catalog is changed."""
+    page = {'content': response.content,
+            'content_type': response['Content-Type']}
+    cache.set(get_page_key(request), page, PAGE_TIMEOUT,
+              version=get_version(PAGE_KEY))
+
+
+def invalidate_pages():
+    """Invalidates cached pages and stores the time of the change."""
+    bump_version(PAGE_KEY)
+    cache.set(PAGE_MODIFIED_KEY, int(time.time()), timeout=None)
+
+
+def get_page_validators(request) -> tuple:
+    """
+    Returns the ETag of the page and the timestamp of the last
+    catalog change, or None if the cache can't keep them.
+
+    Both change every PAGE_TIMEOUT seconds too, so pages show changes
+    of stock, counters, rates and new arrivals that don't invalidate
+    them. Time zone offsets are multiples of PAGE_TIMEOUT, so a window
+    starts at local midnight.
+    """
+    modified = cache.get(PAGE_MODIFIED_KEY)
+    if modified is None:
+        cache.add(PAGE_MODIFIED_KEY, int(time.time()), timeout=None)
+        modified = cache.get(PAGE_MODIFIED_KEY)
+        if modified is None:
+            return None, None
+    window = int(timezone.now().timestamp()) // PAGE_TIMEOUT
+    digest = get_page_key(request).rsplit(':', 1)[-1]
+    etag = f'{digest}-{get_version(PAGE_KEY)}-{window}'
+    return etag, max(modified, window * PAGE_TIMEOUT)
+
+
+def warm_up():
+    """Fills the cache with data displayed on every page."""
+    get_catalog()
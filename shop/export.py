@@ -0,0 +1,120 @@
+import csv
+import zlib
+from itertools import chain, islice
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from . import services
+from .models import Order, OrderItem, Specification
+
+
+CHUNK_SIZE = 2000   # rows fetched from a server-side cursor at a time
+FORMATS = ('csv', 'jsonl')
+CONTENT_TYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+SPEC_COLUMNS = (
+    'id', 'tag', 'category', 'content_type', 'object_id', 'product_name',
+    'product_marking', 'product_unit', 'price', 'discount', 'sale_price',
+    'best_price', 'available_qty', 'weight_vol', 'pre_packing', 'addition',
+    'date_added',
+)
+ORDER_COLUMNS = (
+    'order_id', 'user', 'status', 'order_date', 'order_cost', 'address',
+    'specification_id', 'tag', 'quantity', 'price',
+)
+
+
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def iter_specs(chunk_size=CHUNK_SIZE):
+    """
+    Yields chunks of spec rows with product fields, specs are read
+    with a server-side cursor and products of a chunk in one query.
+
+    The cursor is read in a transaction, a cursor declared in
+    autocommit is WITH HOLD and the whole result is built on commit.
+    """
+    queryset = Specification.objects.select_related('category').order_by(
+        'pk',
+    )
+    with transaction.atomic():
+        for specs in iter_chunks(queryset.iterator(chunk_size), chunk_size):
+            services.load_products(specs, ('id', 'name', 'marking', 'unit'))
+            yield [[
+                spec.id, spec.tag, spec.category.name,
+                ContentType.objects.get_for_id(spec.content_type_id).model,
+                spec.object_id,
+                *(getattr(spec.product, f, None) for f in (
+                    'name', 'marking', 'unit')),
+                spec.price, spec.discount, spec.sale_price, spec.best_price,
+                spec.available_qty, spec.weight_vol, spec.pre_packing,
+                spec.addition, spec.date_added,
+            ] for spec in specs]
+
+
+def iter_orders(chunk_size=CHUNK_SIZE):
+    """
+    Yields chunks of rows of placed orders with an item in each row,
+    read with a server-side cursor in a transaction.
+    """
+    statuses = dict(Order.STATUS_CHOICES)
+    queryset = OrderItem.objects.exclude(order__status=Order.CART).order_by(
+        'order_id', 'pk',
+    ).values_list(
+        'order_id', 'order__user__username', 'order__status',
+        'order__order_date', 'order__order_cost', 'order__address',
+        'specification_id', 'specification__tag', 'quantity', 'price',
+    )
+    with transaction.atomic():
+        for rows in iter_chunks(queryset.iterator(chunk_size), chunk_size):
+            yield [
+                [order_id, user, statuses[status], *values]
+                for order_id, user, status, *values in rows
+            ]
+
+
+class Echo:
+    """Pseudo-buffer returning written values for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def iter_export(chunks, columns, fmt, compress=False):
+    """
+    Yields encoded chunks of rows in the CSV or JSON lines format,
+    optionally compressed with gzip.
+
+    Every chunk is flushed from the compressor, so clients receive data
+    while the rows are read.
+    """
+    if fmt == 'csv':
+        writer = csv.writer(Echo())
+        encoded = chain([writer.writerow(columns)], (
+            ''.join(writer.writerow(row) for row in rows) for rows in chunks
+        ))
+    else:
+        encoder = DjangoJSONEncoder(ensure_ascii=False)
+        encoded = (''.join(
+            encoder.encode(dict(zip(columns, row))) + '\n' for row in rows
+        ) for rows in chunks)
+    if not compress:
+        yield from (data.encode() for data in encoded)
+        return
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for data in encoded:
+        yield compressor.compress(data.encode()) + compressor.flush(
+            zlib.Z_SYNC_FLUSH,
+        )
+    yield compressor.flush()
+
+
+EXPORTS = {
+    'specifications': (iter_specs, SPEC_COLUMNS),
+    'orders': (iter_orders, ORDER_COLUMNS),
+}
@@ -4,9 +4,9 @@ from django.contrib.auth import get_user_model
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
 from django.forms import ModelForm, ValidationError, HiddenInput, RadioSelect
 from django.db.utils import IntegrityError
-from django.db.models import Subquery, OuterRef, F, When, Case, Sum
 
-from .models import OrderItem, Order, Rate
+from . import cache
+from .models import OrderItem, Order, Rate, StockHold
 
 
 class CustomUserCreationForm(UserCreationForm):
@@ -49,26 +49,13 @@ class OrderForm(ModelForm):
         model = Order
         fields = '__all__'
 
+    cost = None
+
     def get_current_cost(self):
-        order = self.instance
-        if order.pk is None:
-            return Decimal('0.00')
-        price_case = Case(
-            When(sale_price__gt=0, then=F('sale_price')),
-            When(discount__gt=0, then=F('discount_price')),
-            default=F('price'),
-        )
-        subquery = Subquery(OrderItem.objects.filter(
-            order=order,
-            specification_id=OuterRef('id')
-        ).order_by().values('quantity'))
-        current_cost = order.specs.annotate(
-            best_price=price_case,
-            item_qty=subquery,
-            total_price=F('best_price') * F('item_qty'),
-        ).aggregate(Sum('total_price'))['total_price__sum']
-        return (current_cost.quantize(order.order_cost) if
-                current_cost is not None else Decimal('0.00'))
+        """Returns the order cost at the current prices, the result of
+        the cost calculation is kept in the cost attribute."""
+        self.cost = self.instance.get_cost()
+        return self.cost.current
 
     def clean_status(self):
         """
@@ -142,7 +129,10 @@ class OrderItemForm(ModelForm):
     def clean_quantity(self):
         qty = self.cleaned_data['quantity']
         spec = self.cleaned_data['specification']
-        if qty > (q := spec.available_qty):
+        held_qty = StockHold.objects.held_qty(
+            spec.id, exclude_order=self.instance.order_id,
+        )
+        if qty > (q := max(spec.available_qty - held_qty, Decimal('0'))):
             raise ValidationError('Only {} left.'.format(
                 q.quantize(Decimal(1)) if q == q.to_integral() else
                 q.normalize()
@@ -154,14 +144,7 @@ class OrderItemForm(ModelForm):
         return qty
 
     def get_price(self):
-        spec = self.cleaned_data['specification']
-        if spec.sale_price:
-            price = spec.sale_price
-        elif spec.discount:
-            price = spec.discount_price
-        else:
-            price = spec.price
-        return price
+        return self.cleaned_data['specification'].best_price
 
     def save(self, commit=True):
         obj = super().save(commit=False)
@@ -178,6 +161,11 @@ class OrderItemForm(ModelForm):
                     order_id=obj.order_id,
                     specification_id=obj.specification.id,
                 ).delete()
+            if obj.order.status == Order.CART:
+                StockHold.objects.hold(obj.order_id, obj.specification_id,
+                                       obj.quantity)
+                cache.set_cart_item(obj.order.user_id,
+                                    obj.specification_id, obj.quantity)
         return obj
 
 
@@ -0,0 +1,113 @@
+import copy
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from shop import cache
+from shop.models import Category, SearchDocument, Specification
+
+
+class Command(BaseCommand):
+    help = ('Scales the catalog to the given number of specs and measures '
+            'the latency of search suggestions.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--specs', type=int, default=100000,
+            help='Number of specs in the scaled catalog.',
+        )
+        parser.add_argument(
+            '--queries', type=int, default=500,
+            help='Number of measured suggestion requests.',
+        )
+        parser.add_argument(
+            '--keep', action='store_true',
+            help='Keep the generated products instead of rolling back.',
+        )
+
+    def scale_catalog(self, num_specs, batch_size=1000):
+        """Copies the existing specs with new products up to num_specs."""
+        templates = list(Specification.objects.all())
+        if not templates:
+            return
+        for i in range(len(templates), num_specs, batch_size):
+            batch = [templates[j % len(templates)] for j in
+                     range(i, min(i + batch_size, num_specs))]
+            # templates repeat in a batch, so every spec and its product
+            # are copied before they get new primary keys
+            batch = [copy.copy(spec) for spec in batch]
+            products = []
+            for j, spec in enumerate(batch, start=i):
+                product = copy.copy(spec.content_object)
+                product.pk = None
+                product.marking = f'{product.marking[:30]}-{j:x}'
+                products.append(product)
+            by_model = {}
+            for product in products:
+                by_model.setdefault(type(product), []).append(product)
+            for model, objs in by_model.items():
+                model.objects.bulk_create(objs)
+            specs = []
+            for spec, product in zip(batch, products):
+                spec.pk = None
+                spec.object_id = product.pk
+                specs.append(spec)
+            Specification.objects.bulk_create(specs)
+
+    def get_prefixes(self, num):
+        """Returns prefixes of words from category and product names."""
+        words = set()
+        for title in SearchDocument.objects.values_list(
+                'title', flat=True)[:1000]:
+            words.update(title.split())
+        words.update(Category.objects.values_list('name', flat=True))
+        words = [w for w in words if len(w) > 1]
+        return [
+            random.choice(words)[:random.randint(2, 5)] for _ in range(num)
+        ]
+
+    def measure(self, func, args_list) -> list:
+        timings = []
+        for args in args_list:
+            start = time.perf_counter()
+            func(*args)
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def report(self, name, timings):
+        timings = sorted(timings)
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+        self.stdout.write(
+            f'{name}: p50 {statistics.median(timings):.2f} ms, '
+            f'p99 {p99:.2f} ms, max {timings[-1]:.2f} ms'
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            start = time.perf_counter()
+            self.scale_catalog(options['specs'])
+            SearchDocument.objects.refresh()
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'ANALYZE {SearchDocument._meta.db_table}, '
+                    f'{Specification._meta.db_table}'
+                )
+            self.stdout.write(
+                f'{Specification.objects.count()} specs ready in '
+                f'{time.perf_counter() - start:.1f} s.'
+            )
+            prefixes = self.get_prefixes(options['queries'])
+            query = cache._get_suggestions.__wrapped__
+            self.report('Database', self.measure(
+                query, [(p, 0, 0) for p in prefixes],
+            ))
+            cache._get_suggestions.cache_clear()
+            self.measure(cache._get_suggestions, [(p, 0, 0) for p in prefixes])
+            self.report('In-process cache', self.measure(
+                cache._get_suggestions, [(p, 0, 0) for p in prefixes],
+            ))
+            if not options['keep']:
+                transaction.set_rollback(True)
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.models import StockHold
+
+
+class Command(BaseCommand):
+    help = ('Removes expired and superseded cart holds from '
+            'the stock hold ledger.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help=('Repeat the compaction every INTERVAL seconds, '
+                  'runs once if 0.'),
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            num = StockHold.objects.compact()
+            self.stdout.write(self.style.SUCCESS(
+                f'{num} stock holds removed.'
+            ))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
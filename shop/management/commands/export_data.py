@@ -0,0 +1,55 @@
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop import export
+
+
+class Command(BaseCommand):
+    help = ('Writes specifications with product fields or orders with '
+            'items to a CSV or JSON lines file, compressed with gzip if '
+            'the file name ends with .gz, e.g. orders.jsonl.gz.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('data', choices=list(export.EXPORTS))
+        parser.add_argument('output', type=Path)
+        parser.add_argument(
+            '--chunk-size', type=int, default=export.CHUNK_SIZE,
+            help='Number of rows fetched from the database at a time.',
+        )
+
+    def handle(self, *args, **options):
+        path = options['output']
+        compress = path.name.endswith('.gz')
+        name = path.name[:-3] if compress else path.name
+        file_format = Path(name).suffix.lstrip('.')
+        if file_format not in export.FORMATS:
+            raise CommandError(
+                f'{path}: expected a file name ending with .csv, .jsonl, '
+                f'.csv.gz or .jsonl.gz.'
+            )
+        iter_rows, columns = export.EXPORTS[options['data']]
+        start = reported = time.perf_counter()
+        num = 0
+
+        def count_rows(chunks):
+            """Reports the number of exported rows every second."""
+            nonlocal num, reported
+            for rows in chunks:
+                yield rows
+                num += len(rows)
+                if time.perf_counter() - reported >= 1:
+                    reported = time.perf_counter()
+                    self.stdout.write(
+                        f'{num} rows, {num / (reported - start):.0f} rows/s'
+                    )
+
+        with open(path, 'wb') as file:
+            for data in export.iter_export(
+                    count_rows(iter_rows(options['chunk_size'])),
+                    columns, file_format, compress):
+                file.write(data)
+        self.stdout.write(self.style.SUCCESS(
+            f'{num} rows of {options["data"]} exported.'
+        ))
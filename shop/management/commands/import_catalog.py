@@ -0,0 +1,368 @@
+import csv
+import json
+import time
+from datetime import date
+from itertools import chain, islice
+from pathlib import Path
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import DatabaseError, connection, transaction
+
+from shop import cache
+from shop.models import Category, Product, SearchDocument, Specification
+
+
+STAGE_TABLE = 'shop_import_stage'
+# escapes of special characters in the text format of COPY
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r',
+})
+TEXT_TYPES = ('CharField', 'TextField', 'FileField', 'ImageField')
+
+
+class CopyReader:
+    """File-like object reading rows in the text format of COPY."""
+
+    def __init__(self, rows):
+        self.lines = (
+            '\t'.join(
+                '\\N' if v is None else str(v).translate(COPY_ESCAPES)
+                for v in row
+            ) + '\n' for row in rows
+        )
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class Command(BaseCommand):
+    help = ('Imports categories, products and specifications from CSV or '
+            'JSON lines files named after the models, e.g. category.csv, '
+            'tvproduct.jsonl or specification.csv. Rows are copied into '
+            'a staging table and merged by id, categories by name. '
+            'Categories are referred to by name, product models by '
+            'the model name, images by the name in the media storage.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'files', nargs='+', type=Path,
+            help='Files to import, they are loaded in the model order.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=10000,
+            help=('Number of rows copied and merged at a time, categories '
+                  'are merged at once.'),
+        )
+
+    def handle(self, *args, **options):
+        product_models = Product.__subclasses__()
+        # content type ids by the model names used in files
+        self.ct_map = {
+            model._meta.model_name: ct.id for model, ct in
+            ContentType.objects.get_for_models(*product_models).items()
+        }
+        model_list = [Category, *product_models, Specification]
+        model_map = {model._meta.model_name: model for model in model_list}
+        files = []
+        for path in options['files']:
+            model = model_map.get(path.stem)
+            if model is None or path.suffix not in ('.csv', '.jsonl'):
+                raise CommandError(
+                    f'{path}: expected a .csv or .jsonl file named after '
+                    f'one of the models {", ".join(model_map)}.'
+                )
+            files.append((model_list.index(model), path, model))
+        files.sort(key=lambda item: item[0])
+        self.category_ids = set()
+        with transaction.atomic():
+            for _, path, model in files:
+                self.import_file(path, model, options['batch_size'])
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(
+                        no_style(), [model for _, _, model in files]):
+                    cursor.execute(sql)
+        cache.bump_version(cache.CATALOG_KEY)
+        cache.bump_version(cache.SEARCH_KEY)
+        cache.bump_version(cache.NEW_ARRIVALS_KEY)
+        cache.invalidate_facets(*self.category_ids)
+        cache.invalidate_pages()
+
+    def read_rows(self, file, suffix) -> tuple:
+        """
+        Returns the column names and an iterator of value lists
+        of the rows read one by one from the file.
+        """
+        if suffix == '.csv':
+            reader = csv.reader(file)
+            return next(reader, []), reader
+        lines = (json.loads(line) for line in file if line.strip())
+        first = next(lines, None)
+        if first is None:
+            return [], iter(())
+        columns = list(first)
+
+        def get_values():
+            for row in chain([first], lines):
+                if extra := row.keys() - first.keys():
+                    raise CommandError(
+                        f'Lines have other keys than the first line: '
+                        f'{", ".join(extra)}.'
+                    )
+                yield [row.get(c) for c in columns]
+        return columns, get_values()
+
+    def import_file(self, path, model, batch_size):
+        """Copies the file into the staging table and merges it in batches."""
+        qn = connection.ops.quote_name
+        with open(path, newline='', encoding='utf-8') as file, \
+                connection.cursor() as cursor:
+            columns, rows = self.read_rows(file, path.suffix)
+            queries = self.get_merge_sql(model, columns)
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE {STAGE_TABLE} '
+                f'({", ".join(f"{qn(c)} text" for c in columns)}) '
+                f'ON COMMIT DROP'
+            )
+            if model is Category:
+                # parents may follow subcategories, see after_merge()
+                batch_size = None
+            start, num = time.perf_counter(), 0
+            while batch := list(islice(rows, batch_size)):
+                cursor.execute(f'TRUNCATE {STAGE_TABLE}')
+                cursor.copy_expert(
+                    f'COPY {STAGE_TABLE} FROM STDIN', CopyReader(batch),
+                )
+                try:
+                    self.check_references(cursor, model, columns)
+                    self.before_merge(cursor, model, columns)
+                    pk_list = []
+                    for sql, params in queries:
+                        cursor.execute(sql, params)
+                        pk_list.extend(pk for pk, in cursor.fetchall())
+                    self.after_merge(cursor, model, columns, pk_list)
+                except DatabaseError as exc:
+                    raise CommandError(f'{path}: {exc}')
+                num += len(batch)
+                self.stdout.write(
+                    f'{path.name}: {num} rows, '
+                    f'{num / (time.perf_counter() - start):.0f} rows/s'
+                )
+            cursor.execute(f'DROP TABLE {STAGE_TABLE}')
+        self.stdout.write(self.style.SUCCESS(
+            f'{num} {model._meta.verbose_name_plural} imported.'
+        ))
+
+    @staticmethod
+    def get_default_sql(field):
+        """Returns the default of the field as a query parameter."""
+        if getattr(field, 'auto_now_add', False):
+            return date.today()
+        default = field.get_default()
+        if default is None:
+            return None
+        return field.get_db_prep_save(default, connection)
+
+    def get_value_sql(self, model, field, columns) -> tuple:
+        """
+        Returns the SQL expression and params of the field value
+        of a staging row, empty values are replaced with the default.
+        """
+        value = f's.{connection.ops.quote_name(field.name)}'
+        if field.related_model is ContentType:
+            cases = ' '.join('WHEN %s THEN %s' for _ in self.ct_map)
+            return f'(CASE {value} {cases} END)::integer', [
+                v for item in self.ct_map.items() for v in item
+            ]
+        params = []
+        if field.related_model is Category:
+            value = (f'(SELECT id FROM {Category._meta.db_table} '
+                     f'WHERE name = {value})'
+                     if field.name in columns else 'NULL')
+            if model is Specification and {
+                    'content_type', 'object_id'}.issubset(columns):
+                # the product category is used as in Specification.save
+                cases = ' '.join(
+                    f'WHEN %s THEN (SELECT category_id FROM '
+                    f'{m._meta.db_table} WHERE id = s.object_id::integer)'
+                    for m in Product.__subclasses__()
+                )
+                value = f'COALESCE({value}, CASE s.content_type {cases} END)'
+                params = [m._meta.model_name for m in
+                          Product.__subclasses__()]
+        elif field.get_internal_type() not in TEXT_TYPES:
+            value = f"NULLIF({value}, '')::{field.cast_db_type(connection)}"
+        default = self.get_default_sql(field)
+        if default is None:
+            return value, params
+        return f'COALESCE({value}, %s)', [*params, default]
+
+    def get_merge_sql(self, model, columns) -> list:
+        """
+        Returns queries merging the staging rows into the model table,
+        rows are matched by id, or categories by name, existing ones are
+        updated and the rest inserted. Fields missing in the file get
+        their defaults in new rows and are kept in existing ones.
+        """
+        qn = connection.ops.quote_name
+        table = model._meta.db_table
+        fields = {f.name: f for f in model._meta.concrete_fields}
+        names = [f.name for f in fields.values() if
+                 f.editable or getattr(f, 'auto_now_add', False)]
+        unknown = set(columns).difference(names)
+        if unknown:
+            raise CommandError(
+                f'Unknown columns {", ".join(sorted(unknown))} of '
+                f'{model._meta.model_name}, expected {", ".join(names)}.'
+            )
+        key = 'name' if model is Category and 'id' not in columns else 'id'
+        insert, values, params = [], [], []
+        update, update_params = [], []
+        for field in fields.values():
+            if field.related_model is model or (
+                    field.primary_key and field.name not in columns):
+                # parents are set after the merge, see after_merge()
+                continue
+            if field.name in columns or field.name == 'category' and (
+                    model is Specification):
+                value, value_params = self.get_value_sql(
+                    model, field, columns,
+                )
+                if field.name in columns and field.name != key:
+                    update.append(f'{qn(field.column)} = {value}')
+                    update_params.extend(value_params)
+            elif field.null:
+                continue
+            else:
+                value, value_params = '%s', [self.get_default_sql(field)]
+                if value_params[0] is None and key not in columns:
+                    raise CommandError(
+                        f'Column {field.name} of {model._meta.model_name} '
+                        f'is required.'
+                    )
+            insert.append(qn(field.column))
+            values.append(value)
+            params.extend(value_params)
+        queries = []
+        where = ''
+        if key in columns:
+            key_value, key_params = self.get_value_sql(
+                model, fields[key], columns,
+            )
+            if update:
+                queries.append((
+                    f'UPDATE {table} AS t SET {", ".join(update)} '
+                    f'FROM {STAGE_TABLE} AS s WHERE t.{qn(key)} = {key_value} '
+                    f'RETURNING t.id', [*update_params, *key_params],
+                ))
+            where = (f'WHERE NOT EXISTS (SELECT FROM {table} AS t '
+                     f'WHERE t.{qn(key)} = {key_value})')
+            params.extend(key_params)
+        queries.append((
+            f'INSERT INTO {table} ({", ".join(insert)}) '
+            f'SELECT {", ".join(values)} FROM {STAGE_TABLE} AS s {where} '
+            f'RETURNING id', params,
+        ))
+        return queries
+
+    def check_references(self, cursor, model, columns):
+        """Raises CommandError if staging rows refer to unknown objects."""
+        if 'content_type' in columns:
+            cursor.execute(
+                f'SELECT DISTINCT content_type FROM {STAGE_TABLE} '
+                f'WHERE content_type <> ALL(%s)', [list(self.ct_map)],
+            )
+            if unknown := [v for v, in cursor.fetchall()]:
+                raise CommandError(
+                    f'Unknown product models {", ".join(unknown)}.'
+                )
+        if 'category' in columns and model is not Category:
+            cursor.execute(
+                f'SELECT DISTINCT s.category FROM {STAGE_TABLE} AS s '
+                f'LEFT JOIN {Category._meta.db_table} AS c '
+                f"ON c.name = s.category WHERE s.category <> '' "
+                f'AND c.id IS NULL'
+            )
+            if unknown := [v for v, in cursor.fetchall()]:
+                raise CommandError(f'Unknown categories {", ".join(unknown)}.')
+
+    def before_merge(self, cursor, model, columns):
+        """
+        Moves specs of products with a changed category to the new one,
+        as Product.save does.
+        """
+        if model in (Category, Specification) or not {
+                'id', 'category'}.issubset(columns):
+            return
+        cursor.execute(
+            f'UPDATE {Specification._meta.db_table} AS spec '
+            f'SET category_id = c.id FROM {STAGE_TABLE} AS s '
+            f'JOIN {model._meta.db_table} AS p ON p.id = s.id::integer '
+            f'JOIN {Category._meta.db_table} AS c ON c.name = s.category '
+            f'WHERE spec.content_type_id = %s AND spec.object_id = p.id '
+            f'AND p.category_id <> c.id '
+            f'RETURNING p.category_id, spec.category_id',
+            [self.ct_map[model._meta.model_name]],
+        )
+        for ids in cursor.fetchall():
+            self.category_ids.update(ids)
+
+    def after_merge(self, cursor, model, columns, pk_list):
+        """Updates data derived from the merged rows as their saves do."""
+        if model is Specification:
+            # the discount is rounded half to even as Decimal.quantize
+            cursor.execute(
+                f'UPDATE {model._meta.db_table} SET discount_price = price - '
+                f'CASE WHEN price * discount %% 1 = 0.5 '
+                f'THEN trunc(price * discount / 100, 2) '
+                f'+ trunc(price * discount) %% 2 / 100 '
+                f'ELSE round(price * discount / 100, 2) END '
+                f'WHERE id = ANY(%s) RETURNING category_id', [pk_list],
+            )
+            self.category_ids.update(c for c, in cursor.fetchall())
+            # also refreshes the search documents
+            Specification.objects.filter(pk__in=pk_list).update_best_price()
+            return
+        if model is Category:
+            if 'category' in columns:
+                table = model._meta.db_table
+                cursor.execute(
+                    f'SELECT DISTINCT s.category FROM {STAGE_TABLE} AS s '
+                    f'LEFT JOIN {table} AS c ON c.name = s.category '
+                    f"WHERE s.category <> '' AND c.id IS NULL"
+                )
+                if unknown := [v for v, in cursor.fetchall()]:
+                    raise CommandError(
+                        f'Unknown parent categories {", ".join(unknown)}.'
+                    )
+                cursor.execute(
+                    f'UPDATE {table} AS c SET category_id = parent.id '
+                    f'FROM {STAGE_TABLE} AS s LEFT JOIN {table} AS parent '
+                    f'ON parent.name = s.category WHERE c.name = s.name '
+                    f'AND c.category_id IS DISTINCT FROM parent.id'
+                )
+            self.category_ids.update(pk_list)
+            specs = Specification.objects.filter(
+                category_id__in=pk_list,
+            ) | Specification.objects.filter(
+                category__category_id__in=pk_list,
+            )
+        else:
+            specs = Specification.objects.filter(
+                content_type_id=self.ct_map[model._meta.model_name],
+                object_id__in=pk_list,
+            )
+            self.category_ids.update(
+                specs.order_by().values_list('category_id', flat=True),
+            )
+        SearchDocument.objects.refresh(specs)
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.models import ImageJob
+
+
+class Command(BaseCommand):
+    help = ('Resizes uploaded images queued in the image jobs and '
+            'replaces the uploaded files with the processed ones.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help=('Check the queue every INTERVAL seconds, '
+                  'drains it once if 0.'),
+        )
+        parser.add_argument(
+            '--limit', type=int, default=None,
+            help='Maximal number of jobs processed in a run.',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            num = ImageJob.objects.process(limit=options['limit'])
+            if num or not options['interval']:
+                self.stdout.write(self.style.SUCCESS(
+                    f'{num} images processed.'
+                ))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from shop.models import RatingSummary
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the product rating summary table from the rates.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of summaries created in a single query.',
+        )
+
+    def handle(self, *args, **options):
+        num = RatingSummary.objects.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Rating summary rebuilt for {num} products.'
+        ))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from shop.models import SearchDocument, Specification
+
+
+class Command(BaseCommand):
+    help = 'Creates or updates the search documents of all product specs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of documents updated in a single query.',
+        )
+
+    def handle(self, *args, **options):
+        queryset = Specification.objects.order_by('pk')
+        last_pk, num = 0, 0
+        while True:
+            pk_list = list(queryset.filter(pk__gt=last_pk).values_list(
+                'pk', flat=True,
+            )[:options['batch_size']])
+            if not pk_list:
+                break
+            num += SearchDocument.objects.refresh(
+                Specification.objects.filter(pk__in=pk_list),
+            )
+            last_pk = pk_list[-1]
+        self.stdout.write(self.style.SUCCESS(
+            f'{num} search documents updated.'
+        ))
@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from shop.models import Specification
+
+
+class Command(BaseCommand):
+    help = ('Recounts placed orders of specifications and decays their '
+            'popularity score by the age of orders.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--half-life', type=float,
+            default=Specification.POPULARITY_HALF_LIFE.days,
+            help='Number of days after which the weight of an order halves.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of specs updated in a single query.',
+        )
+
+    def handle(self, *args, **options):
+        half_life = timedelta(days=options['half_life'])
+        queryset = Specification.objects.order_by('pk')
+        last_pk, num = 0, 0
+        while pk_list := list(queryset.filter(pk__gt=last_pk).values_list(
+                'pk', flat=True)[:options['batch_size']]):
+            num += Specification.objects.filter(
+                pk__in=pk_list,
+            ).refresh_popularity(half_life)
+            last_pk = pk_list[-1]
+        self.stdout.write(self.style.SUCCESS(
+            f'{num} specifications updated.'
+        ))
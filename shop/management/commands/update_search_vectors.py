@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+
+from shop.models import Category, Product, Specification
+
+
+class Command(BaseCommand):
+    help = ('Populates the stored search vectors of categories, products '
+            'and specifications in batches, the vectors are computed by '
+            'the search triggers of the tables.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of rows updated in a single query.',
+        )
+        parser.add_argument(
+            '--missing', action='store_true',
+            help='Update only rows without a search vector.',
+        )
+
+    def update_search_vectors(self, model, batch_size, missing) -> int:
+        """
+        Updates the rows of the model in batches ordered by id, the update
+        of search_vector fires the trigger which recomputes it.
+        """
+        queryset = model.objects.order_by('pk')
+        if missing:
+            queryset = queryset.filter(search_vector__isnull=True)
+        last_pk, num = 0, 0
+        while True:
+            pk_list = list(queryset.filter(pk__gt=last_pk).values_list(
+                'pk', flat=True,
+            )[:batch_size])
+            if not pk_list:
+                return num
+            num += model.objects.filter(pk__in=pk_list).update(
+                search_vector=None,
+            )
+            last_pk = pk_list[-1]
+
+    def handle(self, *args, **options):
+        for model in [Category, Specification, *Product.__subclasses__()]:
+            num = self.update_search_vectors(
+                model, options['batch_size'], options['missing'],
+            )
+            self.stdout.write(self.style.SUCCESS(
+                f'{num} {model._meta.verbose_name_plural} updated.'
+            ))
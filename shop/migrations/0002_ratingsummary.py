@@ -0,0 +1,75 @@
+# Generated by Django 3.2.3 on 2026-10-18 04:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_rating_summaries(apps, schema_editor):
+    Rate = apps.get_model('shop', 'Rate')
+    RatingSummary = apps.get_model('shop', 'RatingSummary')
+    rates = Rate.objects.order_by().values(
+        'content_type_id', 'object_id',
+    ).annotate(count=models.Count('id'), sum=models.Sum('point'))
+    RatingSummary.objects.bulk_create(
+        [RatingSummary(avg=r['sum'] / r['count'], **r) for r in rates],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('shop', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('sum', models.PositiveIntegerField(default=0)),
+                ('avg', models.FloatField(null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'rating summaries',
+            },
+        ),
+        migrations.RemoveConstraint(
+            model_name='rate',
+            name='user_rate_unique',
+        ),
+        migrations.AlterField(
+            model_name='rate',
+            name='content_type',
+            field=models.ForeignKey(limit_choices_to={'app_label': 'shop', 'model__endswith': 'product'}, on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype'),
+        ),
+        migrations.AlterField(
+            model_name='rate',
+            name='point',
+            field=models.IntegerField(choices=[(5, 'Five'), (4, 'Four'), (3, 'Three'), (2, 'Two'), (1, 'One')], default=0),
+        ),
+        migrations.AddConstraint(
+            model_name='rate',
+            constraint=models.UniqueConstraint(fields=('user', 'content_type', 'object_id'), name='user_rate_unique'),
+        ),
+        migrations.AddField(
+            model_name='ratingsummary',
+            name='content_type',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype'),
+        ),
+        migrations.AddField(
+            model_name='specification',
+            name='rating',
+            field=models.ForeignObject(from_fields=('content_type', 'object_id'), null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='shop.ratingsummary', to_fields=('content_type', 'object_id')),
+        ),
+        migrations.AddConstraint(
+            model_name='ratingsummary',
+            constraint=models.UniqueConstraint(fields=('content_type', 'object_id'), name='rating_summary_unique'),
+        ),
+        migrations.RunPython(
+            create_rating_summaries, migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.3 on 2026-10-18 04:23
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+def set_best_price(apps, schema_editor):
+    Specification = apps.get_model('shop', 'Specification')
+    Specification.objects.update(best_price=models.Case(
+        models.When(sale_price__gt=0, then=models.F('sale_price')),
+        models.When(discount__gt=0, then=models.F('discount_price')),
+        default=models.F('price'),
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0002_ratingsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='specification',
+            name='best_price',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=Decimal('0'), editable=False, help_text='The price paid by customers.', max_digits=9),
+        ),
+        migrations.RunPython(set_best_price, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.3 on 2026-10-18 04:32
+
+from decimal import Decimal
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0003_specification_best_price'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.DecimalField(decimal_places=3, max_digits=6, validators=[django.core.validators.MinValueValidator(Decimal('0'))])),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='shop.order')),
+                ('specification', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holds', to='shop.specification')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='stockhold',
+            index=models.Index(fields=['specification', 'order'], name='stock_hold_spec_order_idx'),
+        ),
+    ]
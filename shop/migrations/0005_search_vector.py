@@ -0,0 +1,117 @@
+# Generated by Django 3.2.3 on 2026-10-18 04:35
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+SEARCH_FIELDS = {
+    'shop_category': ('name',),
+    'shop_specification': ('tag',),
+    'shop_tvproduct': ('name', 'marking'),
+    'shop_smartphoneproduct': ('name', 'marking'),
+    'shop_clothingproduct': ('name', 'marking'),
+    'shop_foodproduct': ('name', 'marking'),
+}
+
+
+def get_trigger_sql(table, fields):
+    """Keeps the search vector in sync with the search fields."""
+    return (
+        f'CREATE TRIGGER {table}_search_trigger '
+        f'BEFORE INSERT OR UPDATE OF {", ".join(fields)}, search_vector '
+        f'ON {table} FOR EACH ROW EXECUTE FUNCTION tsvector_update_trigger('
+        f"search_vector, 'pg_catalog.english', {', '.join(fields)});"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0004_stockhold'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='category',
+            name='shop_category_vector_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='clothingproduct',
+            name='clothingproduct_vector_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='foodproduct',
+            name='foodproduct_vector_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='smartphoneproduct',
+            name='smartphoneproduct_vector_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='specification',
+            name='shop_specification_vector_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='tvproduct',
+            name='tvproduct_vector_idx',
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='clothingproduct',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='foodproduct',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='smartphoneproduct',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='specification',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='tvproduct',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='category',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='shop_category_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='clothingproduct',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='clothingproduct_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='foodproduct',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='foodproduct_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='smartphoneproduct',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='smartphoneproduct_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='specification',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='shop_specification_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tvproduct',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='tvproduct_search_idx'),
+        ),
+    ] + [
+        migrations.RunSQL(
+            get_trigger_sql(table, fields),
+            f'DROP TRIGGER {table}_search_trigger ON {table};',
+        ) for table, fields in SEARCH_FIELDS.items()
+    ]
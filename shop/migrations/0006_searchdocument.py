@@ -0,0 +1,66 @@
+# Generated by Django 3.2.3 on 2026-10-18 04:37
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+import django.db.models.deletion
+
+PRODUCT_MODELS = (
+    'tvproduct', 'smartphoneproduct', 'clothingproduct', 'foodproduct',
+)
+# each spec looks up its product in the table of its content type
+PRODUCTS_SQL = ' UNION ALL '.join(
+    f'SELECT name, marking, description FROM shop_{model} '
+    f"WHERE ct.model = '{model}' AND id = spec.object_id"
+    for model in PRODUCT_MODELS
+)
+FILL_DOCUMENTS_SQL = (
+    'INSERT INTO shop_searchdocument (specification_id, category_id, '
+    'parent_category_id, text, search_vector, best_price, rating_avg, '
+    'rating_count) '
+    'SELECT spec.id, spec.category_id, cat.category_id, '
+    "concat_ws(' ', p.name, p.marking, spec.tag, cat.name, parent.name), "
+    "setweight(to_tsvector('english', "
+    "concat_ws(' ', p.name, p.marking)), 'A') || "
+    "setweight(to_tsvector('english', "
+    "concat_ws(' ', cat.name, parent.name)), 'B') || "
+    "setweight(to_tsvector('english', spec.tag), 'C') || "
+    "setweight(to_tsvector('english', p.description), 'D'), "
+    'spec.best_price, rating.avg, COALESCE(rating.count, 0) '
+    'FROM shop_specification AS spec '
+    'JOIN django_content_type AS ct ON ct.id = spec.content_type_id '
+    f'JOIN LATERAL ({PRODUCTS_SQL}) AS p ON true '
+    'JOIN shop_category AS cat ON cat.id = spec.category_id '
+    'LEFT JOIN shop_category AS parent ON parent.id = cat.category_id '
+    'LEFT JOIN shop_ratingsummary AS rating '
+    'ON rating.content_type_id = spec.content_type_id '
+    'AND rating.object_id = spec.object_id;'
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0005_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('specification', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='shop.specification')),
+                ('text', models.TextField()),
+                ('search_vector', django.contrib.postgres.search.SearchVectorField()),
+                ('best_price', models.DecimalField(decimal_places=2, max_digits=9)),
+                ('rating_avg', models.FloatField(null=True)),
+                ('rating_count', models.PositiveIntegerField(default=0)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='shop.category')),
+                ('parent_category', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='shop.category')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='searchdocument',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='shop_searchdocument_search_idx'),
+        ),
+        migrations.RunSQL(FILL_DOCUMENTS_SQL, migrations.RunSQL.noop),
+    ]
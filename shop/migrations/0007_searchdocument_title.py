@@ -0,0 +1,37 @@
+# Generated by Django 3.2.3 on 2026-10-18 04:40
+
+from django.db import migrations, models
+
+PRODUCT_MODELS = (
+    'tvproduct', 'smartphoneproduct', 'clothingproduct', 'foodproduct',
+)
+# each spec looks up its product in the table of its content type
+PRODUCTS_SQL = ' UNION ALL '.join(
+    f'SELECT name, marking FROM shop_{model} '
+    f"WHERE ct.model = '{model}' AND id = spec.object_id"
+    for model in PRODUCT_MODELS
+)
+FILL_TITLES_SQL = (
+    "UPDATE shop_searchdocument AS doc SET title = "
+    "concat_ws(' ', p.name, p.marking) "
+    'FROM shop_specification AS spec '
+    'JOIN django_content_type AS ct ON ct.id = spec.content_type_id '
+    f'JOIN LATERAL ({PRODUCTS_SQL}) AS p ON true '
+    'WHERE spec.id = doc.specification_id;'
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0006_searchdocument'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchdocument',
+            name='title',
+            field=models.CharField(default='', max_length=81),
+        ),
+        migrations.RunSQL(FILL_TITLES_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 3.2.3 on 2026-10-18 05:00
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+# product facet fields by the product model
+FACET_FIELDS = {
+    'tvproduct': ('screen_diagonal', 'screen_resolution'),
+    'smartphoneproduct': ('ram', 'memory'),
+    'clothingproduct': ('type', 'size'),
+    'foodproduct': (),
+}
+# each spec looks up its product in the table of its content type
+PRODUCTS_SQL = ' UNION ALL '.join(
+    'SELECT jsonb_build_object({}) AS attributes FROM shop_{} '
+    "WHERE ct.model = '{}' AND id = spec.object_id".format(
+        ', '.join(f"'{name}', {name}" for name in fields), model, model,
+    ) for model, fields in FACET_FIELDS.items()
+)
+FILL_ATTRIBUTES_SQL = (
+    'UPDATE shop_searchdocument AS doc SET attributes = p.attributes '
+    'FROM shop_specification AS spec '
+    'JOIN django_content_type AS ct ON ct.id = spec.content_type_id '
+    f'JOIN LATERAL ({PRODUCTS_SQL}) AS p ON true '
+    'WHERE spec.id = doc.specification_id;'
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_searchdocument_title'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchdocument',
+            name='attributes',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.AddIndex(
+            model_name='searchdocument',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['attributes'], name='shop_searchdocument_attrs_idx', opclasses=['jsonb_path_ops']),
+        ),
+        migrations.RunSQL(FILL_ATTRIBUTES_SQL, migrations.RunSQL.noop),
+    ]
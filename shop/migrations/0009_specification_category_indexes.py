@@ -0,0 +1,21 @@
+# Generated by Django 3.2.3 on 2026-10-18 05:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0008_searchdocument_attributes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='specification',
+            index=models.Index(condition=models.Q(('available_qty__gt', 0)), fields=['category', 'best_price', 'id'], name='spec_category_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='specification',
+            index=models.Index(condition=models.Q(('available_qty__gt', 0)), fields=['category', '-date_added', '-id'], name='spec_category_date_idx'),
+        ),
+    ]
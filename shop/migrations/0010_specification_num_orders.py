@@ -0,0 +1,43 @@
+# Generated by Django 3.2.3 on 2026-10-18 05:05
+
+from django.db import migrations, models
+
+COUNT_ORDERS_SQL = (
+    'UPDATE shop_order SET counted = true WHERE status IN (2, 3, 4);'
+    'UPDATE shop_specification AS spec '
+    'SET num_orders = stats.num, popularity = stats.num '
+    'FROM (SELECT item.specification_id AS id, count(*) AS num '
+    'FROM shop_orderitem AS item JOIN shop_order AS o '
+    'ON o.id = item.order_id WHERE o.counted '
+    'GROUP BY item.specification_id) AS stats WHERE spec.id = stats.id;'
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0009_specification_category_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='counted',
+            field=models.BooleanField(default=False, editable=False, help_text='The order is counted in the number of spec orders.'),
+        ),
+        migrations.AddField(
+            model_name='specification',
+            name='num_orders',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='number of orders'),
+        ),
+        migrations.AddField(
+            model_name='specification',
+            name='popularity',
+            field=models.FloatField(default=0, editable=False, help_text='The number of orders decayed by their age.'),
+        ),
+        migrations.AddIndex(
+            model_name='specification',
+            index=models.Index(condition=models.Q(('available_qty__gt', 0), ('num_orders__gt', 0)), fields=['category', '-popularity', 'id'], name='spec_category_popular_idx'),
+        ),
+        migrations.RunSQL(COUNT_ORDERS_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.3 on 2026-10-18 05:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_specification_num_orders'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='specification',
+            name='spec_category_date_idx',
+        ),
+        migrations.AddIndex(
+            model_name='specification',
+            index=models.Index(condition=models.Q(('available_qty__gt', 0)), fields=['category', 'date_added'], name='spec_category_date_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.3 on 2026-10-18 05:56
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0012_imagejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagejob',
+            name='run_after',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,60 @@
+from django.db import migrations
+
+SEARCH_FIELDS = {
+    'shop_category': ('name',),
+    'shop_specification': ('tag',),
+    'shop_tvproduct': ('name', 'marking'),
+    'shop_smartphoneproduct': ('name', 'marking'),
+    'shop_clothingproduct': ('name', 'marking'),
+    'shop_foodproduct': ('name', 'marking'),
+}
+
+
+def get_function_sql(table, fields):
+    """
+    Computes the search vector on every insert and update of the
+    search fields or the vector, unlike tsvector_update_trigger which
+    skips updates that don't change the search fields, so setting
+    the vector to NULL recomputes it.
+    """
+    columns = ', '.join(f'NEW.{field}' for field in fields)
+    return (
+        f'CREATE FUNCTION {table}_search_vector() RETURNS trigger AS $$ '
+        f'BEGIN NEW.search_vector := to_tsvector('
+        f"'pg_catalog.english', concat_ws(' ', {columns})); "
+        f'RETURN NEW; END $$ LANGUAGE plpgsql;'
+    )
+
+
+def get_trigger_sql(table, fields, function):
+    return (
+        f'DROP TRIGGER {table}_search_trigger ON {table}; '
+        f'CREATE TRIGGER {table}_search_trigger '
+        f'BEFORE INSERT OR UPDATE OF {", ".join(fields)}, search_vector '
+        f'ON {table} FOR EACH ROW EXECUTE FUNCTION {function};'
+    )
+
+
+def get_legacy_function(table, fields):
+    return (
+        f"tsvector_update_trigger(search_vector, 'pg_catalog.english', "
+        f"{', '.join(fields)})"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0013_imagejob_run_after'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            get_function_sql(table, fields) + get_trigger_sql(
+                table, fields, f'{table}_search_vector()',
+            ),
+            get_trigger_sql(
+                table, fields, get_legacy_function(table, fields),
+            ) + f'DROP FUNCTION {table}_search_vector();',
+        ) for table, fields in SEARCH_FIELDS.items()
+    ]
@@ -1,19 +1,33 @@
+import logging
+import random
+import re
+import time
+from collections import Counter
+from datetime import timedelta
 from decimal import Decimal
+from typing import NamedTuple
 
-from django.db import models, transaction, IntegrityError
+from django.db import models, transaction, connection, OperationalError
+from django.db.models.functions import Coalesce
+from django.db.models.query import ModelIterable
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.fields import (GenericForeignKey,
                                                 GenericRelation)
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.postgres.search import SearchVector
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.contrib.postgres.search import (
+    SearchQuery, SearchRank, SearchVectorField,
+)
 from django.contrib.postgres.indexes import GinIndex
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.urls import reverse
+from django.utils import timezone
 
 from . import services
 
 
 USER = get_user_model()
+logger = logging.getLogger(__name__)
 
 
 class Account(USER):
@@ -52,14 +66,16 @@ class Category(models.Model):
                           'model__endswith': 'product'},
     )
 
+    search_vector = SearchVectorField(null=True, editable=False)
+
     objects = CategoryManager()
 
     class Meta:
         ordering = ['name']
         verbose_name_plural = 'categories'
         indexes = (
-            GinIndex(SearchVector('name', config='english'),
-                     name='%(app_label)s_%(class)s_vector_idx'),
+            GinIndex(fields=['search_vector'],
+                     name='%(app_label)s_%(class)s_search_idx'),
         )
 
     def __str__(self):
@@ -112,37 +128,136 @@ class Product(models.Model):
     category = models.ForeignKey(
         'Category', on_delete=models.PROTECT, related_name='+',
     )
+    search_vector = SearchVectorField(null=True, editable=False)
     specs = GenericRelation('Specification')
     rates = GenericRelation('Rate')
 
+    # fields used to filter category listings
+    FACET_FIELDS = ()
+
     class Meta:
         abstract = True
         ordering = ['-date_added']
         indexes = (
-            GinIndex(SearchVector('name', 'marking', config='english'),
-                     name='%(class)s_vector_idx'),
+            GinIndex(fields=['search_vector'], name='%(class)s_search_idx'),
         )
 
     def __str__(self):
         return f'{self.category} {self.name} {self.marking}'
 
+    @property
+    def image_url(self):
+        return services.get_image_url(getattr(self, 'image'))
+
     def save(self, *args, **kwargs):
         """
-        Extends save method, resizes an image, updates specs category.
+        Extends save method, queues an uploaded image to be resized,
+        updates specs category.
 
         When a category field is updated, it changes a category field
-        in the specs related model.
-        """
-        services.handle_image_size(getattr(self, 'image'))
-        is_category_updated = False
-        if self.id is not None:
-            model = getattr(self, '_meta').model
-            is_category_updated = not model.objects.filter(
-                pk=self.pk, category_id=self.category_id,
-            ).exists()
-        super().save(*args, **kwargs)
-        if is_category_updated:
+        in the specs related model before the product is saved, so
+        the post_save signal refreshes their search documents.
+        """
+        is_image_uploaded = services.is_image_uploaded(getattr(self, 'image'))
+        model = getattr(self, '_meta').model
+        if self.id is not None and not model.objects.filter(
+                pk=self.pk, category_id=self.category_id).exists():
             self.specs.update(category_id=self.category_id)
+        super().save(*args, **kwargs)
+        if is_image_uploaded:
+            ImageJob.objects.enqueue(self, 'image')
+
+
+class ProductRelatedQuerySet(models.QuerySet):
+    """
+    QuerySet for models related to products through the ContentType,
+    can load products of fetched objects with services.load_products.
+    """
+    _product_fields = False
+
+    def with_products(self, fields=services.PRODUCT_FIELDS):
+        """
+        Attaches products to objects in the product attribute
+        when the queryset is evaluated.
+        """
+        clone = self._chain()
+        clone._product_fields = fields
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._product_fields = self._product_fields
+        return clone
+
+    def _fetch_all(self):
+        is_fetched = self._result_cache is not None
+        super()._fetch_all()
+        if (is_fetched or self._product_fields is False or
+                not issubclass(self._iterable_class, ModelIterable)):
+            return
+        services.load_products(self._result_cache, self._product_fields)
+
+
+class SpecificationQuerySet(ProductRelatedQuerySet):
+
+    def update_best_price(self):
+        """
+        Recalculates the stored best price with a single query,
+        used after bulk updates of prices or discounts.
+        """
+        num = self.update(best_price=models.Case(
+            models.When(sale_price__gt=0, then=models.F('sale_price')),
+            models.When(discount__gt=0, then=models.F('discount_price')),
+            default=models.F('price'),
+        ))
+        SearchDocument.objects.refresh(self)
+        return num
+
+    def with_free_qty(self, exclude_order=None):
+        """
+        Annotates specs with the available quantity minus
+        the quantity held in the carts of other orders.
+        """
+        held = StockHold.objects.active(exclude_order=exclude_order).filter(
+            specification_id=models.OuterRef('id'),
+        ).order_by().values('specification_id').annotate(
+            held_qty=models.Sum('quantity'),
+        ).values('held_qty')
+        return self.annotate(free_qty=models.F('available_qty') - Coalesce(
+            models.Subquery(held), Decimal('0'),
+            output_field=models.DecimalField(),
+        ))
+
+    def refresh_popularity(self, half_life) -> int:
+        """
+        Recounts placed orders of the specs and their popularity score,
+        the sum of orders weighted by half every half_life days since
+        the order date, returns the number of updated specs.
+        """
+        spec_table = self.model._meta.db_table
+        item_table = OrderItem._meta.db_table
+        order_table = Order._meta.db_table
+        ids_sql, ids_params = self.order_by().values(
+            'id').query.sql_with_params()
+        sql = (
+            f'WITH locked AS ('
+            f'SELECT id FROM {spec_table} WHERE id IN ({ids_sql}) '
+            f'ORDER BY id FOR UPDATE), '
+            f'stats AS ('
+            f'SELECT item.specification_id AS id, count(*) AS num, '
+            f'sum(power(0.5, extract(epoch FROM now() - o.order_date) / %s))'
+            f' AS score FROM {item_table} AS item '
+            f'JOIN {order_table} AS o ON o.id = item.order_id '
+            f'JOIN locked ON locked.id = item.specification_id '
+            f'WHERE o.counted GROUP BY item.specification_id) '
+            f'UPDATE {spec_table} AS spec '
+            f'SET num_orders = COALESCE(stats.num, 0), '
+            f'popularity = COALESCE(stats.score, 0) '
+            f'FROM locked LEFT JOIN stats ON stats.id = locked.id '
+            f'WHERE spec.id = locked.id RETURNING spec.id'
+        )
+        params = [*ids_params, half_life.total_seconds()]
+        return len(Order.execute_locked(sql, params))
 
 
 class Specification(models.Model):
@@ -187,6 +302,10 @@ class Specification(models.Model):
         help_text=('Special price replaces the discount price, '
                    '0 is disabled'),
     )
+    best_price = models.DecimalField(
+        editable=False, max_digits=9, decimal_places=2, db_index=True,
+        default=Decimal('0'), help_text='The price paid by customers.',
+    )
     available_qty = models.DecimalField(
         max_digits=6, decimal_places=3, verbose_name='available quantity',
         validators=[MinValueValidator(Decimal('0'))],
@@ -195,6 +314,13 @@ class Specification(models.Model):
         max_length=100, blank=True, verbose_name='additional information',
     )
     date_added = models.DateField(auto_now_add=True)
+    num_orders = models.PositiveIntegerField(
+        editable=False, default=0, verbose_name='number of orders',
+    )
+    popularity = models.FloatField(
+        editable=False, default=0,
+        help_text='The number of orders decayed by their age.',
+    )
     category = models.ForeignKey(
         'Category', on_delete=models.PROTECT, related_name='specs',
     )
@@ -203,6 +329,18 @@ class Specification(models.Model):
     )
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey('content_type', 'object_id')
+    rating = models.ForeignObject(
+        'RatingSummary', on_delete=models.DO_NOTHING, null=True,
+        from_fields=('content_type', 'object_id'),
+        to_fields=('content_type', 'object_id'), related_name='+',
+    )
+
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    # the weight of an order in the popularity halves in this time
+    POPULARITY_HALF_LIFE = timedelta(days=30)
+
+    objects = SpecificationQuerySet.as_manager()
 
     class Meta:
         constraints = [
@@ -210,8 +348,22 @@ class Specification(models.Model):
                 check=models.Q(available_qty__gte=0), name='qty_gte_0'),
         ]
         indexes = (
-            GinIndex(SearchVector('tag', config='english'),
-                     name='%(app_label)s_%(class)s_vector_idx'),
+            GinIndex(fields=['search_vector'],
+                     name='%(app_label)s_%(class)s_search_idx'),
+            # orderings of listings of available specs, the price index
+            # serves category_id IN (...) ordered by (category, price, id),
+            # the others order specs of a single subcategory, for parent
+            # categories they only filter and matching specs are sorted
+            models.Index(fields=['category', 'best_price', 'id'],
+                         condition=models.Q(available_qty__gt=0),
+                         name='spec_category_price_idx'),
+            models.Index(fields=['category', 'date_added'],
+                         condition=models.Q(available_qty__gt=0),
+                         name='spec_category_date_idx'),
+            models.Index(fields=['category', '-popularity', 'id'],
+                         condition=models.Q(available_qty__gt=0,
+                                            num_orders__gt=0),
+                         name='spec_category_popular_idx'),
         )
 
     def __str__(self):
@@ -226,18 +378,34 @@ class Specification(models.Model):
         }
         return reverse('shop:spec_detail', kwargs=kwargs)
 
+    def get_best_price(self):
+        """Returns the sale, discount or regular price in that order."""
+        if self.sale_price:
+            return self.sale_price
+        elif self.discount:
+            return self.discount_price
+        return self.price
+
+    @property
+    def image_url(self):
+        return services.get_image_url(getattr(self, 'image'))
+
     def save(self, *args, **kwargs):
         """
-        Extends save method, resizes an image, calculates a discount price
-        and adds category from a product model.
+        Extends save method, queues an uploaded image to be resized,
+        calculates a discount and best price, adds category from
+        a product model.
         """
-        services.handle_image_size(getattr(self, 'image'))
+        is_image_uploaded = services.is_image_uploaded(getattr(self, 'image'))
         self.discount_price = self.price - (
                 self.price * self.discount / 100
         ).quantize(self.price)
+        self.best_price = self.get_best_price()
         if self.category_id is None:
             self.category_id = self.content_object.category_id
         super().save(*args, **kwargs)
+        if is_image_uploaded:
+            ImageJob.objects.enqueue(self, 'image')
 
 
 class ShippingAddress(models.Model):
@@ -267,6 +435,14 @@ class ShippingAddress(models.Model):
         return f'{self.full_name}, {self.address}, {self.city}'
 
 
+class OrderCost(NamedTuple):
+    """Costs of order items at the current and stored prices."""
+    current: Decimal
+    stored: Decimal
+    num_items: int
+    drifted_specs: list
+
+
 class Order(models.Model):
     """
     Creates a table in the database and manages user orders.
@@ -292,10 +468,24 @@ class Order(models.Model):
         validators=[MinValueValidator(Decimal('0'))],
     )
     reserved = models.BooleanField(default=False)
+    counted = models.BooleanField(
+        default=False, editable=False,
+        help_text='The order is counted in the number of spec orders.',
+    )
     order_date = models.DateTimeField(auto_now=True)
     user = models.ForeignKey(USER, on_delete=models.CASCADE)
     specs = models.ManyToManyField(Specification, through='OrderItem')
 
+    LOCK_RETRIES = 3
+    LOCK_RETRY_DELAY = 0.05     # seconds before the first retry
+    # serialization_failure and deadlock_detected error codes
+    LOCK_RETRY_PGCODES = ('40001', '40P01')
+    lock_stats = Counter()
+    # statuses of orders counted in the popularity of specs
+    COUNTED_STATUSES = (PROCESSING, SHIPPING, FINISHED)
+    # set when specs of the order are sold out or back in stock
+    stock_changed = False
+
     class Meta:
         ordering = ['-id']
         constraints = [
@@ -306,44 +496,195 @@ class Order(models.Model):
     def __str__(self):
         return f'{self.user} order No.{self.pk}'
 
+    @classmethod
+    def execute_locked(cls, sql, params) -> list:
+        """
+        Executes a query that locks specs and returns the result rows.
+
+        The query is repeated on a deadlock or serialization failure
+        up to LOCK_RETRIES times with an exponential backoff,
+        the number of retries and failures is counted in lock_stats
+        and logged with the totals of the process.
+        """
+        for attempt in range(cls.LOCK_RETRIES + 1):
+            try:
+                with transaction.atomic(), connection.cursor() as cursor:
+                    cursor.execute(sql, params)
+                    return cursor.fetchall()
+            except OperationalError as exc:
+                pgcode = getattr(exc.__cause__, 'pgcode', None)
+                if (pgcode not in cls.LOCK_RETRY_PGCODES or
+                        attempt == cls.LOCK_RETRIES):
+                    cls.lock_stats['failures'] += 1
+                    logger.error('Order lock failed: %s (%s retries, '
+                                 '%s failures)', exc,
+                                 cls.lock_stats['retries'],
+                                 cls.lock_stats['failures'])
+                    raise
+                cls.lock_stats['retries'] += 1
+                logger.warning('Order lock retried: %s (%s retries, '
+                               '%s failures)', exc,
+                               cls.lock_stats['retries'],
+                               cls.lock_stats['failures'])
+                delay = cls.LOCK_RETRY_DELAY * 2 ** attempt
+                time.sleep(delay * random.uniform(0.5, 1.5))
+
+    def get_cost(self) -> OrderCost:
+        """
+        Calculates the order cost at the current best prices and at
+        the prices stored in items, collects ids of specs whose price
+        has changed, with a single aggregate query.
+        """
+        zero = Decimal('0.00')
+        if self.pk is None:
+            return OrderCost(zero, zero, 0, [])
+        price_field = models.DecimalField(max_digits=9, decimal_places=2)
+        cost = OrderItem.objects.filter(order_id=self.pk).aggregate(
+            current=models.Sum(
+                models.F('quantity') * models.F('specification__best_price'),
+                output_field=price_field,
+            ),
+            stored=models.Sum(models.F('quantity') * models.F('price'),
+                              output_field=price_field),
+            num_items=models.Count('id'),
+            drifted_specs=ArrayAgg('specification_id', filter=~models.Q(
+                price=models.F('specification__best_price'),
+            )),
+        )
+        return OrderCost(
+            current=(cost['current'] or zero).quantize(zero),
+            stored=(cost['stored'] or zero).quantize(zero),
+            num_items=cost['num_items'],
+            drifted_specs=cost['drifted_specs'],
+        )
+
     def reserve_available_quantity(self) -> bool:
         """
         Reduces the product spec available quantity by order item qty.
+
+        Specs are locked in the order of id, then all of them are
+        updated with a single query only if the available quantity
+        of each is enough, otherwise the ids of missing specs are
+        stored in the unavailable_specs attribute. The quantity held
+        in the carts of other orders is not available, the holds
+        of the order are released when the reservation succeeds.
+        stock_changed is set if a spec is sold out by the order.
         """
-        items = self.specs.through.objects.select_related(
-            'specification',
-        ).select_for_update().filter(order_id=self.id)
-        try:
-            with transaction.atomic():
-                for item in items:
-                    spec = item.specification
-                    new_qty = models.F('available_qty') - item.quantity
-                    spec.available_qty = new_qty
-                    spec.save()
-        except IntegrityError:
+        spec_table = Specification._meta.db_table
+        item_table = OrderItem._meta.db_table
+        hold_table = StockHold._meta.db_table
+        held_sql, held_params = StockHold.objects.active(
+            exclude_order=self.id,
+        ).filter(specification__orderitem__order_id=self.id).order_by(
+        ).values('specification_id').annotate(
+            quantity=models.Sum('quantity'),
+        ).query.sql_with_params()
+        sql = (
+            f'WITH items AS ('
+            f'SELECT specification_id, quantity FROM {item_table} '
+            f'WHERE order_id = %s), '
+            f'held AS ({held_sql}), '
+            f'locked AS ('
+            f'SELECT spec.id, spec.available_qty - '
+            f'COALESCE(held.quantity, 0) >= items.quantity '
+            f'AS is_available FROM {spec_table} AS spec '
+            f'JOIN items ON spec.id = items.specification_id '
+            f'LEFT JOIN held ON spec.id = held.specification_id '
+            f'ORDER BY spec.id FOR UPDATE OF spec), '
+            f'reserved AS ('
+            f'UPDATE {spec_table} AS spec '
+            f'SET available_qty = spec.available_qty - items.quantity '
+            f'FROM items WHERE spec.id = items.specification_id '
+            f'AND NOT EXISTS (SELECT FROM locked WHERE NOT is_available) '
+            f'RETURNING spec.available_qty), '
+            f'released AS ('
+            f'DELETE FROM {hold_table} WHERE order_id = %s '
+            f'AND NOT EXISTS (SELECT FROM locked WHERE NOT is_available)) '
+            f'SELECT ARRAY(SELECT id FROM locked WHERE NOT is_available), '
+            f'EXISTS (SELECT FROM reserved WHERE available_qty <= 0)'
+        )
+        [(self.unavailable_specs, sold_out)] = self.execute_locked(
+            sql, [self.id, *held_params, self.id],
+        )
+        if self.unavailable_specs:
             return False
-        else:
-            self.reserved = True
-            return True
+        self.reserved = True
+        self.stock_changed = self.stock_changed or sold_out
+        return True
 
     def cancel_reserved_quantity(self):
         """increase the available product quantity
-        by item quantity from the order."""
-        items = self.specs.through.objects.select_related(
-            'specification',
-        ).filter(order_id=self.id)
-        for item in items:
-            spec = item.specification
-            spec.available_qty = models.F('available_qty') + item.quantity
-            spec.save()
+        by item quantity from the order, sets stock_changed
+        if a sold out spec is back in stock."""
+        spec_table = Specification._meta.db_table
+        item_table = OrderItem._meta.db_table
+        sql = (
+            f'WITH locked AS ('
+            f'SELECT spec.id FROM {spec_table} AS spec '
+            f'JOIN {item_table} AS item ON spec.id = item.specification_id '
+            f'WHERE item.order_id = %s ORDER BY spec.id FOR UPDATE OF spec), '
+            f'released AS ('
+            f'UPDATE {spec_table} AS spec '
+            f'SET available_qty = spec.available_qty + item.quantity '
+            f'FROM {item_table} AS item JOIN locked '
+            f'ON locked.id = item.specification_id '
+            f'WHERE item.order_id = %s AND spec.id = item.specification_id '
+            f'RETURNING spec.available_qty - item.quantity AS old_qty) '
+            f'SELECT EXISTS (SELECT FROM released WHERE old_qty <= 0)'
+        )
+        [(restocked,)] = self.execute_locked(sql, [self.id, self.id])
         self.reserved = False
+        self.stock_changed = self.stock_changed or restocked
+
+    def update_num_orders(self, is_counted=None) -> bool:
+        """
+        Counts the order in the number of orders and popularity of
+        its specs when it is placed and discounts it when it is
+        canceled, returned to the cart or is_counted is False.
+
+        A placed order adds 1 to the popularity, a discounted one
+        subtracts its weight decayed since the order date as in
+        refresh_popularity with POPULARITY_HALF_LIFE.
+
+        Returns True if the counters of specs have been changed.
+        """
+        if is_counted is None:
+            is_counted = self.status in self.COUNTED_STATUSES
+        if self.id is None or is_counted == self.counted:
+            return False
+        spec_table = Specification._meta.db_table
+        item_table = OrderItem._meta.db_table
+        order_table = self._meta.db_table
+        weight = '1' if is_counted else (
+            f'(SELECT power(0.5, extract(epoch FROM now() - order_date) '
+            f'/ %s) FROM {order_table} WHERE id = %s)'
+        )
+        sql = (
+            f'WITH locked AS ('
+            f'SELECT spec.id FROM {spec_table} AS spec '
+            f'JOIN {item_table} AS item ON spec.id = item.specification_id '
+            f'WHERE item.order_id = %s ORDER BY spec.id FOR UPDATE OF spec) '
+            f'UPDATE {spec_table} AS spec '
+            f'SET num_orders = GREATEST(spec.num_orders + %s, 0), '
+            f'popularity = GREATEST(spec.popularity + %s * {weight}, 0) '
+            f'FROM locked WHERE spec.id = locked.id RETURNING spec.id'
+        )
+        delta = 1 if is_counted else -1
+        params = [self.id, delta, delta]
+        if not is_counted:
+            half_life = Specification.POPULARITY_HALF_LIFE.total_seconds()
+            params += [half_life, self.id]
+        self.execute_locked(sql, params)
+        self.counted = is_counted
+        return True
 
     def save(self, *args, **kwargs):
         """Extends the method with a condition for
-        canceled reserved orders."""
+        canceled reserved orders and counts placed orders."""
         if (self.status == self.CANCELED and
                 self.reserved and self.id is not None):
             self.cancel_reserved_quantity()
+        self.update_num_orders()
         super().save(*args, **kwargs)
 
     def delete(self, *args, **kwargs):
@@ -387,6 +728,191 @@ class OrderItem(models.Model):
             super().save(*args, **kwargs)
 
 
+class StockHoldQuerySet(models.QuerySet):
+
+    @staticmethod
+    def superseded() -> models.Exists:
+        """Checks if there is a later hold of the order for the spec."""
+        return models.Exists(StockHold.objects.filter(
+            order_id=models.OuterRef('order_id'),
+            specification_id=models.OuterRef('specification_id'),
+            id__gt=models.OuterRef('id'),
+        ))
+
+    def active(self, exclude_order=None):
+        """
+        Returns unexpired holds of cart orders.
+
+        Only the latest hold of an order for a spec is active,
+        the earlier ones are superseded.
+        """
+        qs = self.filter(
+            ~self.superseded(), order__status=Order.CART,
+            expires_at__gt=timezone.now(),
+        )
+        if exclude_order is not None:
+            qs = qs.exclude(order_id=exclude_order)
+        return qs
+
+    def held_qty(self, spec_id, exclude_order=None) -> Decimal:
+        """Returns the quantity of the spec held in carts."""
+        qty = self.active(exclude_order=exclude_order).filter(
+            specification_id=spec_id,
+        ).aggregate(models.Sum('quantity'))['quantity__sum']
+        return qty or Decimal('0')
+
+    def hold(self, order_id, spec_id, quantity):
+        """Appends a hold of the item quantity for HOLD_TIME."""
+        return self.create(
+            order_id=order_id, specification_id=spec_id, quantity=quantity,
+            expires_at=timezone.now() + self.model.HOLD_TIME,
+        )
+
+    def compact(self) -> int:
+        """
+        Deletes expired and superseded holds, and holds of orders
+        that are no longer in a cart, returns the number of them.
+        """
+        return self.filter(
+            models.Q(expires_at__lte=timezone.now()) |
+            ~models.Q(order__status=Order.CART) | models.Q(self.superseded())
+        ).delete()[0]
+
+
+class StockHold(models.Model):
+    """
+    Append-only ledger of the spec quantity held in user carts.
+
+    Each change of a cart item appends a new hold that supersedes
+    the previous one of the order, holds expire after HOLD_TIME
+    and are removed from the table by compaction.
+    """
+    HOLD_TIME = timedelta(minutes=15)
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE)
+    specification = models.ForeignKey(
+        Specification, on_delete=models.CASCADE, related_name='holds',
+    )
+    quantity = models.DecimalField(
+        max_digits=6, decimal_places=3,
+        validators=[MinValueValidator(Decimal('0'))],
+    )
+    expires_at = models.DateTimeField(db_index=True)
+
+    objects = StockHoldQuerySet.as_manager()
+
+    class Meta:
+        indexes = (
+            models.Index(fields=['specification', 'order'],
+                         name='stock_hold_spec_order_idx'),
+        )
+
+    def __str__(self):
+        return f'{self.specification_id}: {self.quantity}'
+
+
+class ImageJobQuerySet(models.QuerySet):
+
+    def enqueue(self, obj, field_name):
+        """Queues the uploaded image of the object field."""
+        return self.create(
+            content_type=ContentType.objects.get_for_model(obj),
+            object_id=obj.pk, field_name=field_name,
+            source=getattr(obj, field_name).name,
+        )
+
+    def process(self, limit=None) -> int:
+        """
+        Runs due jobs one by one in the order they are due, a job
+        locked by another worker is skipped, a failed one is retried
+        later.
+
+        Returns the number of processed jobs, failed ones aren't counted.
+        """
+        num = 0
+        while limit is None or num < limit:
+            with transaction.atomic():
+                job = self.select_for_update(skip_locked=True).filter(
+                    run_after__lte=timezone.now(),
+                ).order_by('run_after', 'id').first()
+                if job is None:
+                    break
+                num += job.run()
+        return num
+
+
+class ImageJob(models.Model):
+    """
+    Queue of uploaded images waiting to be resized.
+
+    Jobs are drained by the process_images command, the processed
+    image replaces the uploaded one only if the object still has it,
+    meanwhile a placeholder is displayed instead of the image.
+    """
+    MAX_ATTEMPTS = 3
+    RETRY_DELAY = timedelta(minutes=1)  # doubled after every failure
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    field_name = models.CharField(max_length=40)
+    source = models.CharField(
+        max_length=255, help_text='Name of the uploaded file.',
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    run_after = models.DateTimeField(default=timezone.now, db_index=True)
+
+    objects = ImageJobQuerySet.as_manager()
+
+    def __str__(self):
+        return self.source
+
+    def run(self) -> bool:
+        """
+        Resizes the image and swaps it in the object, the uploaded file
+        is deleted. A failed job is retried up to MAX_ATTEMPTS times
+        with a growing delay, then the uploaded image is used unchanged.
+
+        The image is processed before the object is locked, so saves
+        of the object don't wait for it. Returns False if the job failed.
+        """
+        model = self.content_type.model_class()
+        storage = model._meta.get_field(self.field_name).storage
+        objects = model.objects.filter(
+            pk=self.object_id, **{self.field_name: self.source},
+        )
+        if objects.exists():
+            try:
+                name = services.process_image(storage, self.source)
+            except Exception as exc:
+                self.attempts += 1
+                logger.error('Image %s processing failed: %s',
+                             self.source, exc)
+                if self.attempts < self.MAX_ATTEMPTS:
+                    self.run_after = timezone.now() + (
+                        self.RETRY_DELAY * 2 ** (self.attempts - 1))
+                    self.save(update_fields=['attempts', 'run_after'])
+                    return False
+                logger.error('Image %s failed %s times, it is used '
+                             'unchanged.', self.source, self.attempts)
+                try:
+                    name = services.copy_pending_image(storage, self.source)
+                except OSError as exc:
+                    logger.error('Image %s copying failed: %s',
+                                 self.source, exc)
+                    self.delete()
+                    return False
+            obj = objects.select_for_update().first()
+            if obj is None:
+                storage.delete(name)
+            else:
+                getattr(obj, self.field_name).name = name
+                obj.save()
+        storage.delete(self.source)
+        self.delete()
+        return True
+
+
 class Rate(models.Model):
 
     class PointValue(models.IntegerChoices):
@@ -405,6 +931,8 @@ class Rate(models.Model):
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey('content_type', 'object_id')
 
+    objects = ProductRelatedQuerySet.as_manager()
+
     class Meta:
         constraints = [
             models.UniqueConstraint(
@@ -417,11 +945,268 @@ class Rate(models.Model):
         return f'{self.user} {self.point} to {self.content_object}'
 
 
+class RatingSummaryManager(models.Manager):
+
+    def refresh(self, content_type_id, object_id):
+        """
+        Recalculates the rating summary of a single product.
+
+        The summary row is locked before the rates are aggregated,
+        so concurrent rate changes of the same product are applied
+        one after another and the last one sees all committed rates.
+        """
+        lookup = {'content_type_id': content_type_id, 'object_id': object_id}
+        with transaction.atomic():
+            self.bulk_create([self.model(**lookup)], ignore_conflicts=True)
+            self.select_for_update().filter(**lookup).get()
+            aggr = Rate.objects.filter(**lookup).aggregate(
+                count=models.Count('id'), sum=models.Sum('point'),
+            )
+            if not aggr['count']:
+                self.filter(**lookup).delete()
+                return None
+            aggr['avg'] = aggr['sum'] / aggr['count']
+            self.filter(**lookup).update(**aggr)
+        return aggr
+
+    def rebuild(self, batch_size=1000):
+        """Deletes all summaries and creates them again from the rates."""
+        rates = Rate.objects.order_by().values(
+            'content_type_id', 'object_id',
+        ).annotate(count=models.Count('id'), sum=models.Sum('point'))
+        with transaction.atomic():
+            self.all().delete()
+            objs = [self.model(avg=r['sum'] / r['count'], **r) for
+                    r in rates.iterator()]
+            self.bulk_create(objs, batch_size=batch_size)
+        return len(objs)
+
+
+class RatingSummary(models.Model):
+    """
+    Stores the number, sum and average of product rates.
+
+    The table is kept up to date by the Rate model signals and
+    is joined to the specification listings instead of
+    aggregating rates for each row.
+    """
+    content_type = models.ForeignKey(
+        ContentType, on_delete=models.CASCADE,
+    )
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey('content_type', 'object_id')
+    count = models.PositiveIntegerField(default=0)
+    sum = models.PositiveIntegerField(default=0)
+    avg = models.FloatField(null=True)
+
+    objects = RatingSummaryManager()
+
+    class Meta:
+        verbose_name_plural = 'rating summaries'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['content_type', 'object_id'],
+                name='rating_summary_unique',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.avg} ({self.count}) to {self.content_object}'
+
+
+class SearchDocumentManager(models.Manager):
+
+    def refresh(self, specs=None) -> int:
+        """
+        Creates or updates documents of the specs queryset, or of all
+        specs, with a single INSERT ... SELECT query.
+
+        The weighted vector ranks product name and marking first,
+        then category names, spec tag and product description.
+        """
+        product_models = Product.__subclasses__()
+        ct_map = ContentType.objects.get_for_models(*product_models)
+        # each spec looks up its product by the primary key of one table
+        products = ' UNION ALL '.join(
+            f'SELECT name, marking, description, '
+            f'{self.get_attributes_sql(model)} AS attributes '
+            f'FROM {model._meta.db_table} '
+            f'WHERE spec.content_type_id = {ct_map[model].id} '
+            f'AND id = spec.object_id'
+            for model in product_models
+        )
+        where, params = '', []
+        if specs is not None:
+            query = specs.order_by().values('id').query
+            spec_sql, params = query.sql_with_params()
+            where = f'WHERE spec.id IN ({spec_sql})'
+        fields = ('category_id', 'parent_category_id', 'title', 'text',
+                  'search_vector', 'attributes', 'best_price', 'rating_avg',
+                  'rating_count')
+        sql = (
+            f'INSERT INTO {self.model._meta.db_table} '
+            f'(specification_id, {", ".join(fields)}) '
+            f'SELECT spec.id, spec.category_id, cat.category_id, '
+            f"concat_ws(' ', p.name, p.marking), "
+            f"concat_ws(' ', p.name, p.marking, spec.tag, cat.name, "
+            f'parent.name), '
+            f"setweight(to_tsvector('english', "
+            f"concat_ws(' ', p.name, p.marking)), 'A') || "
+            f"setweight(to_tsvector('english', "
+            f"concat_ws(' ', cat.name, parent.name)), 'B') || "
+            f"setweight(to_tsvector('english', spec.tag), 'C') || "
+            f"setweight(to_tsvector('english', p.description), 'D'), "
+            f'p.attributes, spec.best_price, rating.avg, '
+            f'COALESCE(rating.count, 0) '
+            f'FROM {Specification._meta.db_table} AS spec '
+            f'JOIN LATERAL ({products}) AS p ON true '
+            f'JOIN {Category._meta.db_table} AS cat '
+            f'ON cat.id = spec.category_id '
+            f'LEFT JOIN {Category._meta.db_table} AS parent '
+            f'ON parent.id = cat.category_id '
+            f'LEFT JOIN {RatingSummary._meta.db_table} AS rating '
+            f'ON rating.content_type_id = spec.content_type_id '
+            f'AND rating.object_id = spec.object_id {where} '
+            f'ON CONFLICT (specification_id) DO UPDATE SET '
+            + ', '.join(f'{f} = EXCLUDED.{f}' for f in fields)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    @staticmethod
+    def get_attributes_sql(model) -> str:
+        """Returns SQL of a json object with the product facet fields."""
+        if not model.FACET_FIELDS:
+            return "'{}'::jsonb"
+        quote_name = connection.ops.quote_name
+        pairs = ', '.join(
+            f"'{name}', {quote_name(model._meta.get_field(name).column)}"
+            for name in model.FACET_FIELDS
+        )
+        return f'jsonb_build_object({pairs})'
+
+    def facet_counts(self, category_ids, price_limits) -> dict:
+        """
+        Counts available specs of the categories by price range,
+        rating, discount and product attributes in a single query.
+
+        Price ranges are numbered from 0 for prices below the first
+        limit, ratings are rounded down.
+        """
+        spec_table = Specification._meta.db_table
+        sql = (
+            f'WITH docs AS ('
+            f'SELECT doc.best_price, doc.rating_avg, doc.attributes, '
+            f'spec.best_price < spec.price AS discounted '
+            f'FROM {self.model._meta.db_table} AS doc '
+            f'JOIN {spec_table} AS spec ON spec.id = doc.specification_id '
+            f'WHERE doc.category_id = ANY(%s) AND spec.available_qty > 0) '
+            f"SELECT 'price', width_bucket(best_price, %s::numeric[])::text, "
+            f'count(*) FROM docs GROUP BY 2 '
+            f"UNION ALL SELECT 'rating', floor(rating_avg)::int::text, "
+            f'count(*) FROM docs WHERE rating_avg IS NOT NULL GROUP BY 2 '
+            f"UNION ALL SELECT 'discount', 'true', count(*) "
+            f'FROM docs WHERE discounted '
+            f"UNION ALL SELECT 'attribute:' || attr.key, attr.value, "
+            f'count(*) FROM docs, jsonb_each_text(docs.attributes) AS attr '
+            f"WHERE attr.value <> '' GROUP BY 1, 2"
+        )
+        counts = {'price': {}, 'rating': {}, 'discount': 0, 'attributes': {}}
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [list(category_ids), list(price_limits)])
+            for facet, value, count in cursor.fetchall():
+                if facet == 'discount':
+                    counts['discount'] = count
+                elif facet.startswith('attribute:'):
+                    name = facet.split(':', 1)[1]
+                    counts['attributes'].setdefault(name, {})[value] = count
+                else:
+                    counts[facet][int(value)] = count
+        return counts
+
+    @staticmethod
+    def get_prefix_query(q: str):
+        """
+        Returns a query matching all words of the text, the last one
+        as a prefix, or None if the text has no words.
+        """
+        words = re.findall(r'\w+', q.lower())
+        if not words:
+            return None
+        value = ' & '.join(words) + ':*'
+        return SearchQuery(value, search_type='raw', config='english')
+
+    def suggest(self, q: str, limit=10, num_candidates=500) -> list:
+        """
+        Returns the best matching available specs for typed text.
+
+        Short prefixes match a large part of the catalog, so only
+        the first num_candidates matches found by the index are ranked.
+        """
+        query = self.get_prefix_query(q)
+        if query is None:
+            return []
+        candidates = self.filter(
+            search_vector=query, specification__available_qty__gt=0,
+        ).values('pk')[:num_candidates]
+        return list(self.filter(pk__in=candidates).annotate(
+            rank=SearchRank(models.F('search_vector'), query),
+        ).order_by('-rank', 'specification_id').values(
+            'specification_id', 'title', 'category__name',
+            'parent_category__name',
+        )[:limit])
+
+
+class SearchDocument(models.Model):
+    """
+    Denormalized search document of a product spec.
+
+    Combines the text of the product, spec and categories in a single
+    weighted vector with the values used for narrowing and sorting,
+    so a search is one indexed query whatever the number of product
+    models. Documents are refreshed from the save paths of specs,
+    products, categories and rates.
+    """
+    specification = models.OneToOneField(
+        Specification, on_delete=models.CASCADE, primary_key=True,
+        related_name='search_document',
+    )
+    category = models.ForeignKey(
+        Category, on_delete=models.CASCADE, related_name='+',
+    )
+    parent_category = models.ForeignKey(
+        Category, on_delete=models.SET_NULL, null=True, related_name='+',
+    )
+    title = models.CharField(max_length=81, default='')
+    text = models.TextField()
+    search_vector = SearchVectorField()
+    attributes = models.JSONField(default=dict)
+    best_price = models.DecimalField(max_digits=9, decimal_places=2)
+    rating_avg = models.FloatField(null=True)
+    rating_count = models.PositiveIntegerField(default=0)
+
+    objects = SearchDocumentManager()
+
+    class Meta:
+        indexes = (
+            GinIndex(fields=['search_vector'],
+                     name='%(app_label)s_%(class)s_search_idx'),
+            GinIndex(fields=['attributes'], opclasses=['jsonb_path_ops'],
+                     name='%(app_label)s_%(class)s_attrs_idx'),
+        )
+
+    def __str__(self):
+        return self.text
+
+
 class TvProduct(Product):
 
     screen_diagonal = models.CharField(max_length=10)
     screen_resolution = models.CharField(max_length=20)
 
+    FACET_FIELDS = ('screen_diagonal', 'screen_resolution')
+
     class Meta(Product.Meta):
         verbose_name = 'TV'
 
@@ -431,6 +1216,8 @@ class SmartphoneProduct(Product):
     ram = models.CharField(max_length=30)
     memory = models.CharField(max_length=30)
 
+    FACET_FIELDS = ('ram', 'memory')
+
     class Meta(Product.Meta):
         verbose_name = 'smartphone'
 
@@ -449,6 +1236,8 @@ class ClothingProduct(Product):
         max_length=2, choices=SIZE_CHOICES, blank=True,
     )
 
+    FACET_FIELDS = ('type', 'size')
+
     class Meta(Product.Meta):
         verbose_name = 'clothing'
         verbose_name_plural = 'clothing'
@@ -1,52 +1,257 @@
-from io import BytesIO
+import hashlib
+import os
+import tempfile
+import time
 from PIL import Image
 
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
-from django.core.files.images import ImageFile, File
+from django.core.files.base import File
+from django.db.models import IntegerField, Value
+from django.templatetags.static import static
 
 
 IMG_SIZE = (600, 600)   # minimal image sizes in pixels
 FILE_SIZE = (3, 'MB')   # maximal file size 'MB' or 'KB' only
+MAX_IMAGE_PIXELS = 40_000_000   # maximal width * height of an image
+IMAGE_FORMATS = ('JPEG', 'PNG', 'WEBP', 'GIF')
+CHUNK_SIZE = 64 << 10   # bytes read and written at a time
+SPOOL_SIZE = 1 << 20    # larger encoded images are spooled to disk
+# product fields displayed in lists of specs, order items and rates
+PRODUCT_FIELDS = ('id', 'name', 'marking', 'image', 'unit')
+PENDING_DIR = 'pending'  # uploaded images waiting to be processed
+PLACEHOLDER_IMAGE = 'shop/placeholder.svg'
+DERIVATIVES_DIR = 'derivatives'  # resized copies of images in media
+DERIVATIVE_WIDTHS = (200, 400, 600)
+DERIVATIVE_FORMATS = ('webp',)
+DERIVATIVE_LOCK_TIMEOUT = 60    # seconds after a lock is stale
 
 
 def get_file_directory_path(instance, filename):
+    """Uploaded images are stored as is in the pending directory."""
     ct_obj = ContentType.objects.get_for_model(instance)
-    return f'{ct_obj.app_label}/{filename}'
+    return f'{ct_obj.app_label}/{PENDING_DIR}/{filename}'
 
 
-def handle_image_size(obj):
+def load_products(objs, fields=PRODUCT_FIELDS, to_attr='product'):
     """
-    Changes dimensions of an image to the dimensions in IMG_SIZE constant.
+    Loads products of generic relation objects in a single query.
 
-    If an image is loaded and the image size is not equal to the IMG_SIZE,
-    the function creates new image object and replaces old one.
+    Groups objects by the content type id, selects only the given
+    fields of all product models with UNION ALL and attaches
+    the product instances to the objects. Other fields are deferred.
+    If fields is None, complete products are loaded with
+    a query for each content type.
     """
-    if (getattr(obj, '_committed', True) or not obj.name or
-            (obj.width, obj.height) == IMG_SIZE):
-        return
+    id_map = {}
+    for obj in objs:
+        id_map.setdefault(obj.content_type_id, set()).add(obj.object_id)
+    if not id_map:
+        return objs
+    models = {i: ContentType.objects.get_for_id(i).model_class() for
+              i in id_map}
+    products = {}
+    if fields is None:
+        for ct_id, model in models.items():
+            for product in model.objects.filter(id__in=id_map[ct_id]):
+                products[ct_id, product.id] = product
+    else:
+        fields = ('id',) + tuple(f for f in fields if f != 'id')
+        queryset_list = [
+            model.objects.filter(id__in=id_map[ct_id]).annotate(
+                ct_id=Value(ct_id, output_field=IntegerField()),
+            ).order_by().values_list('ct_id', *fields)
+            for ct_id, model in models.items()
+        ]
+        queryset = queryset_list[0].union(*queryset_list[1:], all=True)
+        for ct_id, *values in queryset:
+            model = models[ct_id]
+            data = dict(zip(fields, values))
+            names = [f.attname for f in getattr(model, '_meta').concrete_fields
+                     if f.attname in data]
+            product = model.from_db(
+                queryset.db, names, [data[n] for n in names],
+            )
+            products[ct_id, product.id] = product
+    for obj in objs:
+        setattr(obj, to_attr,
+                products.get((obj.content_type_id, obj.object_id)))
+    return objs
+
+
+def is_image_uploaded(obj) -> bool:
+    """Checks if a new image is assigned and not saved yet."""
+    return not getattr(obj, '_committed', True) and bool(obj.name)
+
+
+def is_image_pending(name) -> bool:
+    return f'/{PENDING_DIR}/' in f'/{name}'
+
+
+def get_image_url(obj) -> str:
+    """Returns the image url, a placeholder until it is processed."""
+    if is_image_pending(obj.name):
+        return static(PLACEHOLDER_IMAGE)
+    return obj.url
+
+
+def open_image(file):
+    """
+    Opens the image reading only its header, raises
+    DecompressionBombError if it has more pixels than MAX_IMAGE_PIXELS,
+    so the check is done before the pixels are decoded.
+    """
+    img = Image.open(file)
+    if img.width * img.height > MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError(
+            f'Image has more than {MAX_IMAGE_PIXELS} pixels.'
+        )
+    return img
+
+
+def resize_image(img, size):
+    """
+    Returns the image resized to the size. A JPEG image is decoded
+    at the smallest scale not below the size with draft(), the rest
+    is reduced by an integer factor before resampling.
+    """
+    if img.format == 'JPEG':
+        img.draft(img.mode, size)
+    return img.resize(size, reducing_gap=3.0)
+
+
+def iter_chunks(file):
+    file.seek(0)
+    while chunk := file.read(CHUNK_SIZE):
+        yield chunk
+    file.seek(0)
+
+
+def process_image(storage, name) -> str:
+    """
+    Saves the pending image resized to the dimensions in IMG_SIZE
+    out of the pending directory, returns the name of the new file.
+
+    The name contains a hash of the content, so urls of the image
+    and its derivatives change when the image is replaced. The encoded
+    image is spooled to a temporary file and written in chunks,
+    an image of the right size is copied without decoding.
+    """
+    with storage.open(name) as file, open_image(file) as img, \
+            tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as tmp:
+        if img.size == IMG_SIZE:
+            for chunk in iter_chunks(file):
+                tmp.write(chunk)
+        else:
+            resize_image(img, IMG_SIZE).save(tmp, img.format)
+        return save_processed_image(storage, name, tmp)
+
+
+def copy_pending_image(storage, name) -> str:
+    """
+    Saves the pending image unchanged out of the pending directory,
+    returns the name of the new file. Used when it can't be processed.
+    """
+    with storage.open(name) as file, \
+            tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as tmp:
+        for chunk in iter_chunks(file):
+            tmp.write(chunk)
+        return save_processed_image(storage, name, tmp)
+
+
+def save_processed_image(storage, name, tmp) -> str:
+    """Saves the content of the pending image with its hash in the name."""
+    digest = hashlib.sha1()
+    for chunk in iter_chunks(tmp):
+        digest.update(chunk)
+    directory, _, filename = name.rpartition(f'{PENDING_DIR}/')
+    stem, ext = os.path.splitext(filename)
+    return storage.save(
+        f'{directory}{stem}.{digest.hexdigest()[:12]}{ext}', File(tmp),
+    )
+
+
+def get_derivative_name(name, width, fmt) -> str:
+    return f'{DERIVATIVES_DIR}/{name}/{width}.{fmt}'
+
+
+def get_image_srcset(obj, fmt='webp') -> str:
+    """
+    Returns the srcset attribute value with urls of the image
+    derivatives, empty until the image is processed.
+    """
+    if not obj.name or is_image_pending(obj.name):
+        return ''
+    return ', '.join(
+        f'{obj.storage.url(get_derivative_name(obj.name, w, fmt))} {w}w'
+        for w in DERIVATIVE_WIDTHS
+    )
+
+
+def make_image_derivative(storage, name, width, fmt) -> str:
+    """
+    Saves the image resized to the width in the format if it does
+    not exist and returns its path.
+
+    The derivative is made by one process at a time under a lock file,
+    None is returned if the lock is held by another process. The file
+    is written under a temporary name and renamed, so it is never
+    served incomplete.
+    """
+    path = storage.path(get_derivative_name(name, width, fmt))
+    if os.path.exists(path):
+        return path
+    if not storage.exists(name):
+        raise FileNotFoundError(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lock_path = f'{path}.lock'
+    try:
+        lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if time.time() - os.path.getmtime(lock_path) > (
+                DERIVATIVE_LOCK_TIMEOUT):
+            os.remove(lock_path)
+        return None
     try:
-        with obj.open(), Image.open(obj) as img:
-            new_img = img.resize(IMG_SIZE, reducing_gap=3.0)
-            file = getattr(obj, 'file')
-            name = obj.name if not isinstance(file, File) else (
-                str(obj.name).rpartition('/')[2])
-            new_file = ImageFile(BytesIO(), name)
-            new_img.save(new_file, img.format)
-    except OSError:
-        return
-    setattr(obj, 'file', new_file)
-    setattr(obj, 'name', name)
+        if os.path.exists(path):
+            return path
+        with storage.open(name) as file, open_image(file) as img:
+            height = max(round(img.height * width / img.width), 1)
+            new_img = resize_image(img, (width, height))
+            tmp_path = f'{path}.tmp'
+            new_img.save(tmp_path, fmt.upper(), quality=80)
+        os.replace(tmp_path, path)
+    finally:
+        os.close(lock)
+        os.remove(lock_path)
+    return path
 
 
 def validate_image_size(file):
     """Validate that image dimensions and file size match
-    the values in constants."""
+    the values in constants.
+
+    Only the image header is read to get the format and dimensions.
+    """
     if not getattr(file, '_committed', True):
         b = 20 if FILE_SIZE[1].upper() == 'MB' else 10
         if file.size > (FILE_SIZE[0] << b):
             raise ValidationError(f'The uploaded file is larger than '
                                   f'{FILE_SIZE[0]} {FILE_SIZE[1]}.')
-        if file.width < IMG_SIZE[0] or file.height < IMG_SIZE[1]:
+        file.seek(0)
+        try:
+            with open_image(file) as img:
+                img_format, (width, height) = img.format, img.size
+        except Image.DecompressionBombError:
+            raise ValidationError(f'Image has more than '
+                                  f'{MAX_IMAGE_PIXELS} pixels.')
+        except OSError:
+            raise ValidationError('Upload a valid image.')
+        finally:
+            file.seek(0)
+        if img_format not in IMAGE_FORMATS:
+            raise ValidationError(f'Image format {img_format} '
+                                  f'is not supported.')
+        if width < IMG_SIZE[0] or height < IMG_SIZE[1]:
             raise ValidationError(f'Image sizes are smaller than '
                                   f'{IMG_SIZE[0]}x{IMG_SIZE[1]} pixels.')
@@ -1,7 +1,15 @@
-from django.db.models.signals import pre_delete
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import pre_delete, post_save, post_delete
 from django.dispatch import receiver
 
-from .models import Order
+from . import cache
+from .models import (
+    Category, Order, Product, Rate, RatingSummary, SearchDocument,
+    Specification,
+)
 
 
 @receiver(pre_delete, sender=Order)
@@ -10,3 +18,124 @@ def cancel_reserved_quantity(sender, **kwargs):
     order = kwargs['instance']
     if order.status < sender.SHIPPING and order.reserved:
         order.cancel_reserved_quantity()
+
+
+@receiver(pre_delete, sender=Order)
+def discount_num_orders(sender, **kwargs):
+    """Discount deleted orders in the number of orders of specs."""
+    kwargs['instance'].update_num_orders(is_counted=False)
+
+
+@receiver(post_save, sender=Rate)
+@receiver(post_delete, sender=Rate)
+def refresh_rating_summary(sender, **kwargs):
+    """Update the product rating summary when a rate is changed."""
+    rate = kwargs['instance']
+    RatingSummary.objects.refresh(rate.content_type_id, rate.object_id)
+    specs = Specification.objects.filter(
+        content_type_id=rate.content_type_id, object_id=rate.object_id,
+    )
+    SearchDocument.objects.refresh(specs)
+    transaction.on_commit(partial(
+        cache.invalidate_facets,
+        *specs.values_list('category_id', flat=True),
+    ))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_catalog(sender, **kwargs):
+    """Invalidate the cached catalog when categories are changed."""
+    transaction.on_commit(partial(cache.bump_version, cache.CATALOG_KEY))
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def invalidate_cart(sender, **kwargs):
+    """Invalidate the cached cart when a user order is changed."""
+    transaction.on_commit(partial(
+        cache.invalidate_cart, kwargs['instance'].user_id,
+    ))
+
+
+@receiver(post_save, sender=Specification)
+@receiver(post_delete, sender=Specification)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_search(sender, **kwargs):
+    """Invalidate cached search results when the catalog is changed."""
+    transaction.on_commit(partial(cache.bump_version, cache.SEARCH_KEY))
+
+
+@receiver(post_save, sender=Specification)
+@receiver(post_delete, sender=Specification)
+def invalidate_new_arrivals(sender, **kwargs):
+    """Invalidate cached new arrivals when specs are changed."""
+    transaction.on_commit(partial(
+        cache.bump_version, cache.NEW_ARRIVALS_KEY,
+    ))
+
+
+@receiver(post_save, sender=Specification)
+@receiver(post_delete, sender=Specification)
+@receiver(post_save, sender=Category)
+def invalidate_facets(sender, **kwargs):
+    """Invalidate facet counts of the category of a changed object."""
+    obj = kwargs['instance']
+    transaction.on_commit(partial(
+        cache.invalidate_facets,
+        obj.pk if sender is Category else obj.category_id,
+    ))
+
+
+@receiver(post_save, sender=Specification)
+@receiver(post_delete, sender=Specification)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_pages(sender, **kwargs):
+    """
+    Invalidate cached pages when the catalog is changed, rates and
+    counters of specs are updated on pages when they expire.
+    """
+    transaction.on_commit(cache.invalidate_pages)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def invalidate_order_pages(sender, **kwargs):
+    """Invalidate cached pages when specs are sold out or restocked."""
+    order = kwargs['instance']
+    if order.stock_changed:
+        order.stock_changed = False
+        transaction.on_commit(cache.invalidate_pages)
+
+
+@receiver(post_save, sender=Specification)
+def refresh_spec_search_document(sender, **kwargs):
+    """Update the search document of a saved spec."""
+    spec = kwargs['instance']
+    SearchDocument.objects.refresh(sender.objects.filter(pk=spec.pk))
+
+
+@receiver(post_save, sender=Category)
+def refresh_category_search_documents(sender, **kwargs):
+    """Update the search documents of specs in a saved category."""
+    category = kwargs['instance']
+    SearchDocument.objects.refresh(Specification.objects.filter(
+        Q(category_id=category.pk) | Q(category__category_id=category.pk),
+    ))
+
+
+def refresh_product_search_documents(sender, **kwargs):
+    """Update the search documents of specs of a saved product."""
+    product = kwargs['instance']
+    SearchDocument.objects.refresh(product.specs.all())
+
+
+for product_model in Product.__subclasses__():
+    post_save.connect(refresh_product_search_documents, sender=product_model)
+    post_save.connect(invalidate_search, sender=product_model)
+    post_delete.connect(invalidate_search, sender=product_model)
+    post_save.connect(invalidate_facets, sender=product_model)
+    post_save.connect(invalidate_pages, sender=product_model)
+    post_delete.connect(invalidate_pages, sender=product_model)
@@ -0,0 +1,14 @@
+document.addEventListener('DOMContentLoaded', function() {
+    const meta = document.querySelector('meta[name="csrf-token-url"]');
+    if (!meta) return;
+    const inputs = document.querySelectorAll(
+        'input[name="csrfmiddlewaretoken"]'
+    );
+    if (!inputs.length) return;
+    fetch(meta.content, {credentials: 'same-origin'})
+        .then(response => response.json())
+        .then(function(data) {
+            inputs.forEach(input => { input.value = data.token; });
+        })
+        .catch(() => {});
+});
@@ -0,0 +1,38 @@
+document.addEventListener('DOMContentLoaded', function() {
+    const input = document.querySelector('input[data-suggest-url]');
+    if (!input) return;
+    const datalist = document.getElementById(input.getAttribute('list'));
+    let timer = null;
+    let controller = null;
+
+    function showSuggestions(data) {
+        datalist.innerHTML = '';
+        data.categories.concat(data.specs).forEach(function(item) {
+            const option = document.createElement('option');
+            option.value = item.text;
+            option.dataset.url = item.url;
+            datalist.appendChild(option);
+        });
+    }
+
+    input.addEventListener('input', function() {
+        const option = Array.from(datalist.options).find(
+            o => o.value === input.value
+        );
+        if (option) {
+            window.location.href = option.dataset.url;
+            return;
+        }
+        clearTimeout(timer);
+        timer = setTimeout(function() {
+            if (controller) controller.abort();
+            controller = new AbortController();
+            const url = input.dataset.suggestUrl + '?q=' +
+                encodeURIComponent(input.value);
+            fetch(url, {signal: controller.signal})
+                .then(response => response.json())
+                .then(showSuggestions)
+                .catch(() => {});
+        }, 150);
+    });
+});
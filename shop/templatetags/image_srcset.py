@@ -0,0 +1,13 @@
+from django import template
+
+from ..services import get_image_srcset
+
+register = template.Library()
+
+
+@register.simple_tag
+def image_srcset(image, fmt='webp'):
+    """
+    Returns srcset of the resized copies of an image in the format.
+    """
+    return get_image_srcset(image, fmt)
@@ -0,0 +1,306 @@
+from datetime import timedelta
+from http import HTTPStatus
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache as default_cache
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .. import cache, views
+from ..models import Category, Order, Specification
+
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CatalogCacheTests(TestCase):
+
+    fixtures = ['example_shop_data.json']
+
+    def setUp(self):
+        default_cache.clear()
+
+    def test_catalog_is_cached(self):
+        """The catalog is queried once, then served from the cache."""
+        with self.assertNumQueries(2):
+            catalog = cache.get_catalog()
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get_catalog(), catalog)
+        self.assertTrue(
+            all(hasattr(c, 'subcategories') for c in catalog),
+            msg='Subcategories were not prefetched.',
+        )
+
+    def test_catalog_invalidated_on_category_change(self):
+        """Saving or deleting a category changes the catalog version."""
+        cache.get_catalog()
+        category = Category.objects.filter(category__isnull=True).first()
+        category.name = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            category.save()
+        self.assertIn('Renamed', [c.name for c in cache.get_catalog()])
+        with self.captureOnCommitCallbacks(execute=True):
+            subcategory = Category.objects.create(
+                name='New', category=category,
+                content_type_id=category.content_type_id,
+            )
+        catalog = {c.id: c for c in cache.get_catalog()}
+        self.assertIn(subcategory, catalog[category.id].subcategories)
+        with self.captureOnCommitCallbacks(execute=True):
+            subcategory.delete()
+        catalog = {c.id: c for c in cache.get_catalog()}
+        self.assertNotIn(subcategory, catalog[category.id].subcategories)
+
+    def test_catalog_invalidated_after_commit(self):
+        """Requests before the commit don't cache old rows as new."""
+        version = cache.get_version(cache.CATALOG_KEY)
+        category = Category.objects.first()
+        with self.captureOnCommitCallbacks(execute=True):
+            category.save()
+            self.assertEqual(cache.get_version(cache.CATALOG_KEY), version)
+        self.assertNotEqual(cache.get_version(cache.CATALOG_KEY), version)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CartCacheTests(TestCase):
+
+    fixtures = ['example_shop_data.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(
+            username='test', password='fdf24F42uih',
+        )
+        cls.spec = Specification.objects.filter(available_qty__gt=0).first()
+
+    def setUp(self):
+        default_cache.clear()
+        self.client.force_login(self.user)
+
+    def add_to_cart(self, quantity):
+        data = {'specification': self.spec.id, 'quantity': quantity}
+        response = self.client.post(
+            reverse('shop:add_to_cart'), data=data, secure=True,
+        )
+        self.assertEqual(response.status_code, HTTPStatus.FOUND)
+
+    def test_cart_updated_by_form(self):
+        """The cached cart is written through when items are changed."""
+        self.assertEqual(cache.get_cart(self.user.id), {})
+        self.add_to_cart(self.spec.pre_packing)
+        with self.assertNumQueries(0):
+            cart = cache.get_cart(self.user.id)
+        self.assertEqual(cart, {self.spec.id: self.spec.pre_packing})
+        self.add_to_cart(0)
+        self.assertEqual(cache.get_cart(self.user.id), {})
+
+    def test_cart_invalidated_on_order_change(self):
+        """Placing an order invalidates the cached cart."""
+        self.add_to_cart(self.spec.pre_packing)
+        order = Order.objects.get(user=self.user, status=Order.CART)
+        order.status = Order.PROCESSING
+        with self.captureOnCommitCallbacks(execute=True):
+            order.save()
+        self.assertEqual(cache.get_cart(self.user.id), {})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SearchCacheTests(TestCase):
+
+    fixtures = ['example_shop_data.json']
+
+    def setUp(self):
+        default_cache.clear()
+        self.url = reverse('shop:search')
+        self.spec = Specification.objects.filter(available_qty__gt=0).first()
+        self.product = self.spec.content_object
+
+    def test_normalize_search_terms(self):
+        self.assertEqual(
+            cache.normalize_search_terms('  Red  apple RED\tAPPLE '),
+            ['apple', 'red'],
+        )
+
+    def search(self, q):
+        response = self.client.get(self.url, {'q': q}, secure=True)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return list(response.context['spec_list'])
+
+    def test_search_ids_are_cached(self):
+        """The same normalized query is ranked once."""
+        queryset = Specification.objects.order_by('id')
+        terms = cache.normalize_search_terms(self.product.name)
+        id_list = cache.get_search_ids(terms, queryset)
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get_search_ids(terms, queryset), id_list)
+
+    def test_search_invalidated_on_product_change(self):
+        q = self.product.name
+        self.assertIn(self.spec, self.search(q))
+        self.assertIn(self.spec, self.search(f' {q.upper()} '))
+        self.product.name = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        self.assertNotIn(self.spec, self.search(q))
+        self.assertIn(self.spec, self.search('renamed'))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class NewArrivalCacheTests(TestCase):
+
+    fixtures = ['example_shop_data.json']
+
+    def setUp(self):
+        default_cache.clear()
+        self.spec = Specification.objects.filter(
+            available_qty__gt=0,
+        ).select_related('category__category').first()
+        self.category = self.spec.category.category
+        self.url = reverse('shop:new', args=[self.category.name.lower()])
+
+    def get_spec_ids(self) -> list:
+        response = self.client.get(self.url, secure=True)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return [s.id for s in response.context['spec_list']]
+
+    def test_new_arrival_ids_are_cached(self):
+        since = timezone.localdate() - timedelta(days=14)
+        Specification.objects.update(date_added=since)
+        category = self.spec.category
+        id_list = cache.get_new_arrival_ids(category, since)
+        self.assertIn(self.spec.id, id_list)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                cache.get_new_arrival_ids(category, since), id_list,
+            )
+
+    def test_new_arrivals_window(self):
+        """Specs added before the window are excluded once saved."""
+        Specification.objects.update(date_added=timezone.localdate())
+        self.assertIn(self.spec.id, self.get_spec_ids())
+        self.spec.date_added = timezone.localdate() - timedelta(days=15)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.spec.save()
+        self.assertNotIn(self.spec.id, self.get_spec_ids())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PageCacheTests(TestCase):
+
+    fixtures = ['example_shop_data.json']
+
+    def setUp(self):
+        default_cache.clear()
+        self.url = reverse('shop:home')
+
+    def test_anonymous_page_is_cached(self):
+        """Cached pages are served without queries and CSRF tokens."""
+        response = self.client.get(self.url, secure=True)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        placeholder = views.HomePageView.csrf_token_placeholder
+        self.assertContains(response, placeholder)
+        with self.assertNumQueries(0):
+            cached = self.client.get(self.url, secure=True)
+        self.assertEqual(cached.content, response.content)
+        self.assertNotIn(settings.CSRF_COOKIE_NAME, cached.cookies)
+
+    def test_page_key(self):
+        """The query string is a part of the key in any order."""
+        factory = RequestFactory()
+        key = cache.get_page_key(factory.get(self.url, {'a': 1, 'b': 2}))
+        self.assertEqual(
+            cache.get_page_key(factory.get(f'{self.url}?b=2&a=1')), key,
+        )
+        self.assertNotEqual(
+            cache.get_page_key(factory.get(self.url, {'a': 1})), key,
+        )
+
+    def test_page_invalidated_on_spec_change(self):
+        self.client.get(self.url, secure=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            Specification.objects.first().save()
+        with self.assertNumQueries(0):
+            self.assertIsNone(cache.get_page(RequestFactory().get(self.url)))
+
+    def test_authenticated_page_is_not_cached(self):
+        user = get_user_model().objects.create_user(
+            username='test', password='fdf24F42uih',
+        )
+        self.client.force_login(user)
+        response = self.client.get(self.url, secure=True)
+        self.assertNotIn('ETag', response)
+        self.assertIsNone(cache.get_page(RequestFactory().get(self.url)))
+
+    def test_conditional_get(self):
+        """Unchanged pages are not modified until the catalog changes."""
+        spec = Specification.objects.filter(available_qty__gt=0).first()
+        url = spec.get_absolute_url()
+        response = self.client.get(url, secure=True)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertIn('Last-Modified', response)
+        self.assertEqual(response['X-Accel-Expires'],
+                         str(cache.PAGE_TIMEOUT))
+        for headers in [{'HTTP_IF_NONE_MATCH': response['ETag']}, {
+                'HTTP_IF_MODIFIED_SINCE': response['Last-Modified']}]:
+            with self.assertNumQueries(0):
+                not_modified = self.client.get(url, secure=True, **headers)
+            self.assertEqual(
+                not_modified.status_code, HTTPStatus.NOT_MODIFIED,
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            spec.save()
+        response = self.client.get(
+            url, secure=True, HTTP_IF_NONE_MATCH=response['ETag'],
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+    def test_validators_expire(self):
+        """Stock, counters and new arrivals are updated on expired pages."""
+        response = self.client.get(self.url, secure=True)
+        later = timezone.now() + timedelta(seconds=cache.PAGE_TIMEOUT)
+        with mock.patch.object(timezone, 'now', return_value=later):
+            response = self.client.get(
+                self.url, secure=True, HTTP_IF_NONE_MATCH=response['ETag'],
+                HTTP_IF_MODIFIED_SINCE=response['Last-Modified'],
+            )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+    def test_page_invalidated_on_stock_out(self):
+        """Pages are invalidated when specs are sold out or restocked."""
+        order = Order.objects.create(
+            user=get_user_model().objects.create_user(username='customer'),
+            status=Order.CART,
+        )
+        spec = Specification.objects.first()
+        order.specs.add(spec, through_defaults={
+            'quantity': spec.pre_packing, 'price': spec.price,
+        })
+        request = RequestFactory().get(self.url)
+        for available_qty, is_invalidated in [(spec.pre_packing * 2, False),
+                                              (spec.pre_packing, True)]:
+            Specification.objects.filter(pk=spec.pk).update(
+                available_qty=available_qty,
+            )
+            for method in ('reserve_available_quantity',
+                           'cancel_reserved_quantity'):
+                self.client.get(self.url, secure=True)
+                with self.captureOnCommitCallbacks(execute=True):
+                    getattr(order, method)()
+                    order.save()
+                self.assertEqual(cache.get_page(request) is None,
+                                 is_invalidated)
+
+    def test_csrf_token(self):
+        response = self.client.get(reverse('shop:csrf_token'), secure=True)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertTrue(response.json()['token'])
+        self.assertIn(settings.CSRF_COOKIE_NAME, response.cookies)
+        self.assertIn('no-cache', response['Cache-Control'])
@@ -0,0 +1,166 @@
+import gzip
+import json
+import tempfile
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+
+from ..models import Category, SearchDocument, Specification, TvProduct
+
+
+class ImportCatalogTests(TestCase):
+    fixtures = ['example_shop_data.json']
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = Path(tmp_dir.name)
+
+    def write(self, name, content) -> str:
+        path = self.path / name
+        path.write_text(content)
+        return str(path)
+
+    def import_catalog(self, *files):
+        call_command('import_catalog', *files, batch_size=1,
+                     stdout=StringIO())
+
+    def test_import(self):
+        """Files are loaded in the model order and derived data updated."""
+        products = [
+            {'id': 101, 'name': 'Imported', 'marking': 'X1',
+             'image': 'shop/x.png', 'category': 'Monitor',
+             'description': 'Tab\tand\nline'},
+            {'id': 102, 'name': 'Another', 'marking': 'X2',
+             'image': 'shop/x.png', 'category': 'Monitor',
+             'description': None},
+        ]
+        files = [
+            self.write('specification.csv', (
+                'id,tag,content_type,object_id,price,discount,'
+                'weight_vol,available_qty,sale_price\n'
+                '501,4K,tvproduct,101,20.05,50,1.5,3,\n'
+                '502,8K,tvproduct,102,100.00,10,1,0,15\n'
+            )),
+            self.write('tvproduct.jsonl', '\n'.join(
+                json.dumps(p) for p in products
+            )),
+            self.write('category.csv', (
+                'name,category,content_type\n'
+                'Monitor,Displays,tvproduct\n'
+                'Displays,,tvproduct\n'
+            )),
+        ]
+        self.import_catalog(*files)
+        category = Category.objects.get(name='Monitor')
+        self.assertEqual(category.category.name, 'Displays')
+        product = TvProduct.objects.get(pk=101)
+        self.assertEqual(product.description, 'Tab\tand\nline')
+        self.assertEqual(TvProduct.objects.get(pk=102).description, '')
+        spec = Specification.objects.get(pk=501)
+        self.assertEqual(spec.category, category)
+        self.assertEqual(spec.date_added, product.date_added)
+        self.assertEqual(spec.discount_price, Decimal('10.03'))
+        self.assertEqual(spec.best_price, spec.get_best_price())
+        self.assertEqual(
+            Specification.objects.get(pk=502).best_price, Decimal('15'),
+        )
+        document = SearchDocument.objects.get(specification_id=501)
+        self.assertEqual(document.title, 'Imported X1')
+        self.assertTrue(TvProduct.objects.filter(
+            pk=101, search_vector='imported',
+        ).exists())
+        new_product = TvProduct.objects.create(
+            name='New', marking='X3', category=category,
+        )
+        self.assertGreater(new_product.pk, 102)
+
+    def test_upsert(self):
+        """Existing rows are updated, fields missing in files are kept."""
+        spec = Specification.objects.filter(
+            content_type__model='tvproduct',
+        ).first()
+        product = spec.content_object
+        self.import_catalog(self.write('tvproduct.csv', (
+            f'id,name,category\n{product.pk},Renamed,Smartphone\n'
+        )))
+        product.refresh_from_db()
+        self.assertEqual(product.name, 'Renamed')
+        self.assertEqual(product.category.name, 'Smartphone')
+        spec.refresh_from_db()
+        self.assertEqual(spec.category, product.category)
+        self.assertTrue(SearchDocument.objects.filter(
+            specification=spec, title__startswith='Renamed',
+        ).exists())
+        self.import_catalog(self.write('specification.csv', (
+            f'id,available_qty\n{spec.pk},7\n'
+        )))
+        updated = Specification.objects.get(pk=spec.pk)
+        self.assertEqual(updated.available_qty, Decimal('7'))
+        self.assertEqual(updated.price, spec.price)
+        self.assertEqual(updated.tag, spec.tag)
+
+    def test_invalid_files(self):
+        """Invalid files are rejected and nothing is imported."""
+        num = TvProduct.objects.count()
+        cases = [
+            ('tvproduct.csv', 'id,name,color\n1,A,red\n', 'color'),
+            ('tvproduct.csv', 'name,marking,category\nA,B,Unknown\n',
+             'Unknown'),
+            ('tvproduct.csv', 'name,marking\nA,B\n', 'category'),
+            ('product.csv', 'name\nA\n', 'expected'),
+        ]
+        for name, content, message in cases:
+            with self.subTest(content), \
+                    self.assertRaisesMessage(CommandError, message):
+                self.import_catalog(self.write(name, content))
+        self.assertEqual(TvProduct.objects.count(), num)
+
+
+class ExportDataTests(TestCase):
+    fixtures = ['example_shop_data.json']
+
+    def test_export(self):
+        """Rows are written in the format of the file name."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / 'specifications.jsonl.gz'
+            call_command('export_data', 'specifications', str(path),
+                         chunk_size=3, stdout=StringIO())
+            with gzip.open(path, 'rt') as file:
+                rows = [json.loads(line) for line in file]
+        self.assertEqual(
+            [row['id'] for row in rows],
+            list(Specification.objects.order_by('pk').values_list(
+                'pk', flat=True,
+            )),
+        )
+        with self.assertRaisesMessage(CommandError, 'expected'):
+            call_command('export_data', 'orders', 'orders.txt')
+
+
+class UpdateSearchVectorsTests(TestCase):
+    fixtures = ['example_shop_data.json']
+
+    def test_missing_vectors_are_filled_by_triggers(self):
+        table = TvProduct._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f'ALTER TABLE {table} DISABLE TRIGGER '
+                           f'{table}_search_trigger')
+            cursor.execute(f'UPDATE {table} SET search_vector = NULL')
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            cursor.execute(f'ALTER TABLE {table} ENABLE TRIGGER '
+                           f'{table}_search_trigger')
+        call_command('update_search_vectors', missing=True, batch_size=2,
+                     stdout=StringIO())
+        product = TvProduct.objects.first()
+        self.assertFalse(
+            TvProduct.objects.filter(search_vector__isnull=True).exists(),
+        )
+        self.assertTrue(TvProduct.objects.filter(
+            pk=product.pk, search_vector=product.name.split()[0],
+        ).exists())
@@ -1,24 +1,37 @@
+import threading
+from datetime import timedelta
 from decimal import Decimal
 from io import BytesIO
+from unittest import mock
 from PIL import Image
 
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
 from django.core.files.images import ImageFile
+from django.db import OperationalError, connection
+from django.db.backends.utils import CursorWrapper
 from django.db.utils import IntegrityError
-from django.test import TestCase
-
-from ..services import IMG_SIZE
+from django.templatetags.static import static
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .. import services
+from ..services import (
+    IMG_SIZE, PLACEHOLDER_IMAGE, is_image_pending, validate_image_size,
+)
 from ..models import (
-    Specification, Category, SmartphoneProduct, Order,
+    Specification, Category, SmartphoneProduct, Order, Rate, RatingSummary,
+    SearchDocument, StockHold, ImageJob,
 )
 
 
-def get_data_for_image_field(img_size: tuple) -> ImageFile:
+def get_data_for_image_field(img_size: tuple, img_format='JPEG',
+                             name='test_image.jpg') -> ImageFile:
     img = Image.new('RGB', img_size)
-    name = 'test_image.jpg'
     img_file = ImageFile(BytesIO(), name)
-    img.save(img_file, 'JPEG')
+    img.save(img_file, img_format)
     return img_file
 
 
@@ -50,6 +63,16 @@ class SmartphoneProductTests(TestCase):
             SmartphoneProduct.objects.filter(pk=product.pk).count(), 1,
         )
 
+    def test_search_vector_is_updated(self):
+        """The stored search vector follows the name and marking."""
+        product = self.smartphone
+        product.save()
+        qs = SmartphoneProduct.objects.filter(pk=product.pk)
+        self.assertTrue(qs.filter(search_vector='samsung').exists())
+        qs.update(name='Nokia')
+        self.assertFalse(qs.filter(search_vector='samsung').exists())
+        self.assertTrue(qs.filter(search_vector='nokia').exists())
+
     def test_image_save_in_storage(self):
         img_file = get_data_for_image_field(IMG_SIZE)
         product = self.smartphone
@@ -64,8 +87,73 @@ class SmartphoneProductTests(TestCase):
         product = self.smartphone
         product.image = get_data_for_image_field(large_img_size)
         product.save()
+        self.assertEqual(product.image_url, static(PLACEHOLDER_IMAGE))
+        self.assertEqual(ImageJob.objects.process(), 1)
+        product.refresh_from_db()
         actual_img_size = product.image.width, product.image.height
         self.assertTupleEqual(actual_img_size, IMG_SIZE)
+        self.assertEqual(product.image_url, product.image.url)
+        product.image.delete(save=False)
+
+    def test_image_of_right_size_is_copied(self):
+        """An image of the sizes in IMG_SIZE is stored unchanged."""
+        img_file = get_data_for_image_field(IMG_SIZE)
+        content = img_file.file.getvalue()
+        product = self.smartphone
+        product.image = img_file
+        product.save()
+        ImageJob.objects.process()
+        product.refresh_from_db()
+        with product.image.open() as file:
+            self.assertEqual(file.read(), content)
+        product.image.delete(save=False)
+
+    def test_image_validation(self):
+        """Uploads are validated by the image header."""
+        product = self.smartphone
+        product.image = get_data_for_image_field(IMG_SIZE)
+        validate_image_size(product.image)
+        self.assertEqual(product.image.tell(), 0)
+        with mock.patch('shop.services.MAX_IMAGE_PIXELS', 1000):
+            with self.assertRaisesMessage(ValidationError, 'more than 1000'):
+                validate_image_size(product.image)
+        product.image = get_data_for_image_field(
+            IMG_SIZE, 'BMP', 'test_image.bmp',
+        )
+        with self.assertRaisesMessage(ValidationError, 'BMP'):
+            validate_image_size(product.image)
+        product.image = ImageFile(BytesIO(b'not an image'), 'test_image.jpg')
+        with self.assertRaisesMessage(ValidationError, 'valid image'):
+            validate_image_size(product.image)
+
+    def test_image_bomb_is_not_processed(self):
+        """
+        Images over the pixel limit fail before they are decoded,
+        after the last attempt the upload is used unchanged.
+        """
+        img_file = get_data_for_image_field(IMG_SIZE)
+        content = img_file.file.getvalue()
+        product = self.smartphone
+        product.image = img_file
+        product.save()
+        source = product.image.name
+        with mock.patch('shop.services.MAX_IMAGE_PIXELS', 1000), \
+                self.assertLogs('shop.models', 'ERROR') as logs:
+            for attempt in range(1, ImageJob.MAX_ATTEMPTS):
+                self.assertEqual(ImageJob.objects.process(), 0)
+                job = ImageJob.objects.get()
+                self.assertEqual(job.attempts, attempt)
+                self.assertGreater(job.run_after, timezone.now())
+                self.assertEqual(ImageJob.objects.process(), 0)
+                ImageJob.objects.update(run_after=timezone.now())
+            self.assertEqual(ImageJob.objects.process(), 1)
+        self.assertEqual(len(logs.output), ImageJob.MAX_ATTEMPTS + 1)
+        self.assertFalse(ImageJob.objects.exists())
+        product.refresh_from_db()
+        self.assertFalse(is_image_pending(product.image.name))
+        self.assertFalse(product.image.storage.exists(source))
+        with product.image.open() as file:
+            self.assertEqual(file.read(), content)
         product.image.delete(save=False)
 
 
@@ -134,6 +222,8 @@ class SpecificationTests(TestCase):
         spec = self.specification
         spec.image = get_data_for_image_field(large_img_size)
         spec.save()
+        ImageJob.objects.process()
+        spec.refresh_from_db()
         actual_img_size = spec.image.width, spec.image.height
         self.assertTupleEqual(actual_img_size, IMG_SIZE)
         spec.image.delete(save=False)
@@ -145,10 +235,48 @@ class SpecificationTests(TestCase):
         spec = self.specification
         spec.image = get_data_for_image_field(diff_img_size)
         spec.save()
+        ImageJob.objects.process()
+        spec.refresh_from_db()
         actual_img_size = spec.image.width, spec.image.height
         self.assertTupleEqual(actual_img_size, IMG_SIZE)
         spec.image.delete(save=False)
 
+    def test_replaced_image_is_not_swapped(self):
+        """A job of an image replaced by a new upload is discarded."""
+        spec = self.specification
+        spec.image = get_data_for_image_field(IMG_SIZE)
+        spec.save()
+        source = spec.image.name
+        spec.image = get_data_for_image_field(IMG_SIZE)
+        spec.save()
+        self.assertEqual(ImageJob.objects.process(limit=1), 1)
+        self.assertFalse(spec.image.storage.exists(source))
+        spec.refresh_from_db()
+        self.assertTrue(is_image_pending(spec.image.name))
+        ImageJob.objects.process()
+        spec.refresh_from_db()
+        self.assertFalse(is_image_pending(spec.image.name))
+        spec.image.delete(save=False)
+
+    def test_image_replaced_while_processed(self):
+        """The object isn't locked while its image is processed."""
+        spec = self.specification
+        spec.image = get_data_for_image_field(IMG_SIZE)
+        spec.save()
+        process_image = services.process_image
+        names = []
+
+        def replace_and_process(storage, name):
+            Specification.objects.filter(pk=spec.pk).update(image='new.jpg')
+            names.append(process_image(storage, name))
+            return names[-1]
+
+        with mock.patch('shop.services.process_image', replace_and_process):
+            self.assertEqual(ImageJob.objects.process(), 1)
+        spec.refresh_from_db()
+        self.assertEqual(spec.image.name, 'new.jpg')
+        self.assertFalse(spec.image.storage.exists(names[0]))
+
     def test_discount_price(self):
         """The value for the discount_price field is calculated
         when the save() is called."""
@@ -158,6 +286,24 @@ class SpecificationTests(TestCase):
         spec.save()
         self.assertEqual(spec.discount_price, Decimal('9.00'))
 
+    def test_best_price(self):
+        """
+        The value for the best_price field is the sale price,
+        the discount price or the price in that order.
+        """
+        spec = self.specification
+        spec.discount = 10
+        spec.save()
+        self.assertEqual(spec.best_price, Decimal('9.00'))
+        spec.sale_price = Decimal('8.50')
+        spec.save()
+        self.assertEqual(spec.best_price, Decimal('8.50'))
+        qs = Specification.objects.filter(pk=spec.pk)
+        qs.update(sale_price=Decimal('0'), discount=0)
+        qs.update_best_price()
+        spec.refresh_from_db()
+        self.assertEqual(spec.best_price, spec.price)
+
 
 class OrderTests(TestCase):
 
@@ -301,6 +447,10 @@ class OrderTests(TestCase):
             is_reserved, msg=('The order was reserved with an item '
                               'that is out of stock.')
         )
+        self.assertEqual(
+            self.cart_order.unavailable_specs, [spec_list[-1].id],
+            msg='The out of stock item was not returned.',
+        )
         for spec in self.cart_order.specs.all():
             self.assertEqual(
                 spec.available_qty,
@@ -309,6 +459,29 @@ class OrderTests(TestCase):
                      'unable to rollback db transaction.')
             )
 
+    def test_get_cost(self):
+        """Current and stored costs and specs with changed price."""
+        self.cart_order.save()
+        spec_list = list(Specification.objects.filter(
+            available_qty__gt=0,
+        )[:2])
+        for spec in spec_list:
+            self.cart_order.specs.add(spec, through_defaults={
+                'quantity': spec.pre_packing, 'price': spec.best_price,
+            })
+        stored = sum(s.best_price * s.pre_packing for s in spec_list)
+        changed = spec_list[0]
+        changed.sale_price = changed.best_price + 1
+        changed.save()
+        with self.assertNumQueries(1):
+            cost = self.cart_order.get_cost()
+        self.assertEqual(cost.stored, stored)
+        self.assertEqual(cost.current, stored + changed.pre_packing)
+        self.assertEqual(cost.num_items, 2)
+        self.assertEqual(cost.drifted_specs, [changed.id])
+        empty_cost = Order(user=self.user, status=Order.CART).get_cost()
+        self.assertEqual(empty_cost, (0, 0, 0, []))
+
     def test_order_specs_unique_constraint(self):
         """The same order contains unique product specifications."""
         self.cart_order.save()
@@ -326,3 +499,340 @@ class OrderTests(TestCase):
                'the many-to-many field specs.')
         with self.assertRaises(IntegrityError, msg=msg):
             item.save()
+
+    def test_update_num_orders(self):
+        """
+        Placed orders are counted in the number of spec orders once,
+        canceled ones are discounted.
+        """
+        spec_list = self.fill_cart_order_with_items(2)
+        num_orders = {s.id: s.num_orders for s in spec_list}
+        for status, delta in [(Order.PROCESSING, 1), (Order.SHIPPING, 1),
+                              (Order.FINISHED, 1), (Order.CANCELED, 0)]:
+            self.cart_order.status = status
+            self.cart_order.save()
+            for spec in Specification.objects.filter(id__in=num_orders):
+                self.assertEqual(spec.num_orders, num_orders[spec.id] + delta)
+                self.assertAlmostEqual(spec.popularity, spec.num_orders,
+                                       places=3)
+
+    def test_decayed_weight_is_discounted(self):
+        """A canceled order subtracts the weight it has in popularity."""
+        spec = self.fill_cart_order_with_items(1)[0]
+        self.cart_order.status = Order.FINISHED
+        self.cart_order.save()
+        half_life = Specification.POPULARITY_HALF_LIFE
+        Order.objects.filter(id=self.cart_order.id).update(
+            order_date=timezone.now() - half_life,
+        )
+        Specification.objects.filter(pk=spec.pk).update(
+            num_orders=2, popularity=1.5,
+        )
+        self.cart_order.refresh_from_db()
+        self.cart_order.status = Order.CANCELED
+        self.cart_order.save()
+        spec.refresh_from_db()
+        self.assertEqual(spec.num_orders, 1)
+        self.assertAlmostEqual(spec.popularity, 1, places=3)
+
+    def test_deleted_order_is_discounted(self):
+        spec_list = self.fill_cart_order_with_items(2)
+        num_orders = {s.id: s.num_orders for s in spec_list}
+        self.cart_order.status = Order.FINISHED
+        self.cart_order.save()
+        self.cart_order.delete()
+        for spec in Specification.objects.filter(id__in=num_orders):
+            self.assertEqual(spec.num_orders, num_orders[spec.id])
+            self.assertAlmostEqual(spec.popularity, spec.num_orders,
+                                   places=3)
+
+    def test_refresh_popularity(self):
+        """The popularity of specs is halved every half life."""
+        spec = self.fill_cart_order_with_items(1)[0]
+        self.cart_order.status = Order.FINISHED
+        self.cart_order.save()
+        half_life = timedelta(days=30)
+        Order.objects.filter(id=self.cart_order.id).update(
+            order_date=timezone.now() - half_life,
+        )
+        Specification.objects.update(num_orders=0, popularity=0)
+        num = Specification.objects.refresh_popularity(half_life)
+        self.assertEqual(num, Specification.objects.count())
+        spec.refresh_from_db()
+        self.assertEqual(spec.num_orders, 1)
+        self.assertAlmostEqual(spec.popularity, 0.5, places=3)
+
+
+class OrderConcurrencyTests(TransactionTestCase):
+    """Many customers reserve the same specs at the same time."""
+
+    fixtures = ['example_shop_data.json']
+    num_orders = 12
+
+    def setUp(self):
+        User = get_user_model()
+        self.hot_spec, self.other_spec = Specification.objects.filter(
+            available_qty__gt=0,
+        ).order_by('id')[:2]
+        # There is enough stock only for half of the orders.
+        Specification.objects.filter(id=self.hot_spec.id).update(
+            available_qty=self.hot_spec.pre_packing * (self.num_orders // 2),
+        )
+        Specification.objects.filter(id=self.other_spec.id).update(
+            available_qty=self.other_spec.pre_packing * self.num_orders,
+        )
+        self.orders = []
+        for i in range(self.num_orders):
+            user = User.objects.create_user(username=f'customer{i}')
+            order = Order.objects.create(user=user, status=Order.CART)
+            # Alternate the order of items to provoke deadlocks.
+            specs = [self.hot_spec, self.other_spec]
+            for spec in specs[::1 if i % 2 else -1]:
+                order.specs.add(spec, through_defaults={
+                    'quantity': spec.pre_packing, 'price': spec.price,
+                })
+            self.orders.append(order)
+
+    def reserve(self, order, barrier, results):
+        try:
+            barrier.wait()
+            results.append(order.reserve_available_quantity())
+        except Exception as exc:
+            results.append(exc)
+        finally:
+            connection.close()
+
+    def test_hot_spec_is_not_oversold(self):
+        failures = Order.lock_stats['failures']
+        barrier = threading.Barrier(self.num_orders)
+        results = []
+        threads = [
+            threading.Thread(target=self.reserve,
+                             args=(order, barrier, results))
+            for order in self.orders
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), self.num_orders)
+        self.assertTrue(
+            all(isinstance(r, bool) for r in results),
+            msg=f'Reservation failed with an error: {results}',
+        )
+        self.assertEqual(results.count(True), self.num_orders // 2)
+        self.assertEqual(Order.lock_stats['failures'], failures)
+        self.hot_spec.refresh_from_db()
+        self.assertEqual(self.hot_spec.available_qty, 0)
+        self.other_spec.refresh_from_db()
+        self.assertEqual(
+            self.other_spec.available_qty,
+            self.other_spec.pre_packing * (self.num_orders // 2),
+        )
+
+    def test_lock_stats(self):
+        """Retries and failures on deadlocks are counted and logged."""
+        deadlock = OperationalError('deadlock detected')
+        deadlock.__cause__ = type('DeadlockDetected', (Exception,), {
+            'pgcode': '40P01',
+        })()
+        execute = CursorWrapper.execute
+        errors = [deadlock]
+
+        def execute_with_deadlocks(cursor, sql, params=None):
+            if errors:
+                raise errors.pop()
+            return execute(cursor, sql, params)
+
+        stats = Order.lock_stats.copy()
+        with mock.patch.object(Order, 'LOCK_RETRY_DELAY', 0), \
+                mock.patch.object(CursorWrapper, 'execute',
+                                  execute_with_deadlocks), \
+                self.assertLogs('shop.models', 'WARNING') as logs:
+            self.assertTrue(self.orders[0].reserve_available_quantity())
+            errors.extend([deadlock] * (Order.LOCK_RETRIES + 1))
+            with self.assertRaises(OperationalError):
+                self.orders[1].reserve_available_quantity()
+        self.assertEqual(Order.lock_stats['retries'],
+                         stats['retries'] + 1 + Order.LOCK_RETRIES)
+        self.assertEqual(Order.lock_stats['failures'],
+                         stats['failures'] + 1)
+        self.assertIn(f'{Order.lock_stats["failures"]} failures',
+                      logs.output[-1])
+
+
+class StockHoldTests(TestCase):
+
+    fixtures = ['example_shop_data.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        cls.orders = [
+            Order.objects.create(
+                user=User.objects.create_user(username=f'customer{i}'),
+                status=Order.CART,
+            ) for i in range(2)
+        ]
+        cls.spec = Specification.objects.filter(available_qty__gt=1).first()
+
+    def test_latest_hold_supersedes_previous(self):
+        order, other = self.orders
+        StockHold.objects.hold(order.id, self.spec.id, Decimal('3'))
+        StockHold.objects.hold(order.id, self.spec.id, Decimal('1'))
+        self.assertEqual(StockHold.objects.held_qty(self.spec.id), 1)
+        self.assertEqual(
+            StockHold.objects.held_qty(self.spec.id, exclude_order=order.id),
+            0,
+        )
+        spec = Specification.objects.with_free_qty(
+            exclude_order=other.id,
+        ).get(id=self.spec.id)
+        self.assertEqual(spec.free_qty, self.spec.available_qty - 1)
+
+    def test_expired_holds(self):
+        hold = StockHold.objects.hold(self.orders[0].id, self.spec.id, 1)
+        hold.expires_at = timezone.now()
+        hold.save()
+        self.assertEqual(StockHold.objects.held_qty(self.spec.id), 0)
+        self.assertEqual(StockHold.objects.compact(), 1)
+
+    def test_compact(self):
+        order, other = self.orders
+        StockHold.objects.hold(order.id, self.spec.id, 1)
+        latest = StockHold.objects.hold(order.id, self.spec.id, 2)
+        StockHold.objects.hold(other.id, self.spec.id, 1)
+        Order.objects.filter(id=other.id).update(status=Order.PROCESSING)
+        self.assertEqual(StockHold.objects.compact(), 2)
+        self.assertQuerysetEqual(StockHold.objects.all(), [latest])
+
+    def test_reserve_quantity_held_by_other_order(self):
+        order, other = self.orders
+        qty = self.spec.available_qty
+        order.specs.add(self.spec, through_defaults={
+            'quantity': qty, 'price': self.spec.price,
+        })
+        StockHold.objects.hold(order.id, self.spec.id, qty)
+        StockHold.objects.hold(other.id, self.spec.id, 1)
+        self.assertFalse(order.reserve_available_quantity())
+        StockHold.objects.hold(other.id, self.spec.id, 0)
+        self.assertTrue(order.reserve_available_quantity())
+        self.assertFalse(StockHold.objects.filter(order=order).exists())
+        self.spec.refresh_from_db()
+        self.assertEqual(self.spec.available_qty, 0)
+
+
+class RatingSummaryTests(TestCase):
+
+    fixtures = ['example_shop_data.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        cls.users = [
+            User.objects.create_user(username=f'test{i}', password='test')
+            for i in range(3)
+        ]
+        cls.spec = Specification.objects.first()
+
+    def setUp(self):
+        self.lookup = {'content_type_id': self.spec.content_type_id,
+                       'object_id': self.spec.object_id}
+        Rate.objects.filter(**self.lookup).delete()
+
+    def get_summary(self):
+        return RatingSummary.objects.filter(**self.lookup).first()
+
+    def test_summary_updated_on_rate_changes(self):
+        """Creating, changing and deleting rates updates the summary."""
+        rates = [Rate.objects.create(user=user, point=point, **self.lookup)
+                 for user, point in zip(self.users, (5, 4, 3))]
+        summary = self.get_summary()
+        self.assertIsNotNone(summary, msg='Summary was not created.')
+        self.assertEqual((summary.count, summary.sum), (3, 12))
+        self.assertEqual(summary.avg, 4.0)
+        rates[0].point = 2
+        rates[0].save()
+        summary.refresh_from_db()
+        self.assertEqual((summary.count, summary.sum), (3, 9))
+        self.assertEqual(summary.avg, 3.0)
+        Rate.objects.filter(pk__in=[r.pk for r in rates[1:]]).delete()
+        summary.refresh_from_db()
+        self.assertEqual((summary.count, summary.sum), (1, 2))
+        rates[0].delete()
+        self.assertIsNone(
+            self.get_summary(), msg='Summary without rates was not deleted.',
+        )
+
+    def test_rebuild(self):
+        """The summary table is created again from the rates."""
+        for user, point in zip(self.users, (5, 2)):
+            Rate.objects.create(user=user, point=point, **self.lookup)
+        RatingSummary.objects.filter(**self.lookup).update(count=0, sum=0)
+        RatingSummary.objects.rebuild()
+        summary = self.get_summary()
+        self.assertEqual((summary.count, summary.sum), (2, 7))
+        self.assertEqual(summary.avg, 3.5)
+        self.assertEqual(
+            RatingSummary.objects.count(),
+            Rate.objects.values('content_type_id', 'object_id').distinct(
+            ).count(),
+        )
+
+
+class SearchDocumentTests(TestCase):
+
+    fixtures = ['example_shop_data.json']
+
+    def setUp(self):
+        self.spec = Specification.objects.select_related(
+            'category__category',
+        ).first()
+        self.product = self.spec.content_object
+
+    def get_document(self):
+        return SearchDocument.objects.get(specification_id=self.spec.id)
+
+    def test_documents_of_all_specs(self):
+        self.assertEqual(
+            SearchDocument.objects.count(), Specification.objects.count(),
+        )
+        document = self.get_document()
+        self.assertEqual(document.category_id, self.spec.category_id)
+        self.assertEqual(document.parent_category_id,
+                         self.spec.category.category_id)
+        self.assertEqual(document.best_price, self.spec.best_price)
+        self.assertIn(self.product.marking, document.text)
+
+    def test_refresh_on_category_change(self):
+        """Documents of specs are refreshed once with the new category."""
+        self.product.category = Category.objects.exclude(
+            pk=self.product.category_id,
+        ).filter(category__isnull=False).first()
+        with CaptureQueriesContext(connection) as queries:
+            self.product.save()
+        table = SearchDocument._meta.db_table
+        self.assertEqual(len([q for q in queries if q['sql'].startswith(
+            f'INSERT INTO {table}')]), 1)
+        self.assertEqual(self.get_document().category_id,
+                         self.product.category_id)
+
+    def test_refresh_from_save(self):
+        self.product.marking = 'Xylophone'
+        self.product.save()
+        self.assertIn('Xylophone', self.get_document().text)
+        category = self.spec.category
+        category.name = 'Zithers'
+        category.save()
+        self.assertIn('Zithers', self.get_document().text)
+        self.spec.price = Decimal('1000.00')
+        self.spec.discount = self.spec.sale_price = 0
+        self.spec.save()
+        self.assertEqual(self.get_document().best_price, self.spec.price)
+        user = get_user_model().objects.create_user(username='test')
+        Rate.objects.create(user=user, point=4, content_object=self.product)
+        num_rates = Rate.objects.filter(
+            content_type_id=self.spec.content_type_id,
+            object_id=self.product.id,
+        ).count()
+        self.assertEqual(self.get_document().rating_count, num_rates)
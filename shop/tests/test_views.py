@@ -1,19 +1,63 @@
+import csv
+import gzip
+import json
+import os
+import shutil
 from http import HTTPStatus
+from io import BytesIO
+from unittest import mock
+from urllib.parse import urlencode
+from PIL import Image
 
-from django.db.models import F, Q, Case, When, Sum, Count
+from django.db import connection
+from django.db.models import F, Q, Sum, Count
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models.fields.files import FieldFile
 from django.test import TestCase, RequestFactory, override_settings
 from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
-from .. import views
-from ..models import Specification, Order, Category, Rate
+from .. import cache, services, views
+from ..models import (
+    Specification, Order, OrderItem, Category, Rate, SearchDocument,
+)
 
 
 User = get_user_model()
 
 
+class GetSpecsTests(TestCase):
+
+    fixtures = ['example_shop_data.json']
+
+    def test_products_loaded_in_single_query(self):
+        """
+        Products of all content types are attached to specs
+        with one additional query.
+        """
+        queryset = views.get_specs()
+        ct_ids = set(queryset.values_list('content_type_id', flat=True))
+        self.assertGreater(
+            len(ct_ids), 1, msg='The test data needs specs of '
+                                'different content type products.',
+        )
+        for ct_id in ct_ids:
+            ContentType.objects.get_for_id(ct_id)
+        with self.assertNumQueries(2):
+            spec_list = list(queryset)
+        for spec in spec_list:
+            self.assertEqual(
+                (spec.product.id, type(spec.product)),
+                (spec.object_id, spec.content_type.model_class()),
+            )
+            self.assertTrue(spec.product.name)
+
+
 class HomePageViewTests(TestCase):
 
     fixtures = ['example_shop_data.json']
@@ -211,6 +255,46 @@ class SearchViewTests(TestCase):
                  f'Results: {", ".join(map(str, spec_list))}'),
         )
 
+    def test_search_query_count(self):
+        """Specs of all product models are found in a single query,
+        then their products are loaded."""
+        view = views.SearchView()
+        view.q = list(Category.objects.values_list('name', flat=True)[:3])
+        with self.assertNumQueries(2):
+            spec_list = list(view.get_queryset())
+        self.assertTrue(spec_list)
+
+
+class SearchSuggestViewTests(TestCase):
+
+    fixtures = ['example_shop_data.json']
+
+    def setUp(self):
+        cache._get_suggestions.cache_clear()
+        self.url = reverse('shop:search_suggest')
+
+    def test_suggest_by_prefix(self):
+        spec = Specification.objects.filter(available_qty__gt=0).first()
+        product = spec.content_object
+        prefix = product.name[:3]
+        response = self.client.get(self.url, {'q': prefix}, secure=True)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        suggestions = response.json()
+        self.assertIn(
+            {'text': f'{product.name} {product.marking}',
+             'url': spec.get_absolute_url()},
+            suggestions['specs'],
+        )
+        with self.assertNumQueries(0):
+            self.client.get(self.url, {'q': f' {prefix.upper()} '})
+
+    def test_short_or_empty_query(self):
+        for q in ('', 'a', '&|:*'):
+            response = self.client.get(self.url, {'q': q}, secure=True)
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            self.assertEqual(response.json(),
+                             {'categories': [], 'specs': []})
+
 
 class CategorySpecListTests(TestCase):
 
@@ -261,8 +345,87 @@ class CategorySpecListTests(TestCase):
             available_qty__gt=0,
             category__category_id=category.id,
         ).count()
-        spec_list = list(response.context_data['spec_list'])
+        with self.assertNumQueries(2):
+            spec_list = list(response.context_data['spec_list'])
         self.assertEqual(len(spec_list), n)
+        self.assertGreater(
+            len({s.content_type_id for s in spec_list}), 1,
+            msg='Specs of different content types are in a single query.',
+        )
+
+    def test_keyset_pagination(self):
+        """
+        Pages follow each other by cursors in both directions and
+        contain all products of a category in the view ordering.
+        """
+        category = self.category_qs.filter(
+            Q(categories__content_type_id__lt=F('content_type_id')) |
+            Q(categories__content_type_id__gt=F('content_type_id')),
+        ).first()
+        kwargs = {'category': str(category.name).lower()}
+        url = reverse('shop:category', kwargs=kwargs)
+        factory = RequestFactory()
+        request = factory.get(url)
+        request.user = AnonymousUser()
+        view = views.CategorySpecList.as_view(paginate_by=None)
+        expected = [s.id for s in view(request, **kwargs).context_data[
+            'spec_list'].order_by('category_id', 'best_price', 'id')]
+        self.assertGreater(len(expected), 2, msg='Not enough specs.')
+        view = views.CategorySpecList.as_view(
+            paginate_by=2, keyset_pagination=True,
+        )
+        pages, cursor = [], None
+        for _ in expected:
+            request = factory.get(url, {'cursor': cursor} if cursor else {})
+            request.user = AnonymousUser()
+            page = view(request, **kwargs).context_data['page_obj']
+            pages.append([s.id for s in page])
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+        self.assertEqual(sum(pages, []), expected)
+        self.assertGreater(page.approximate_count, 0)
+        for ids in reversed(pages[:-1]):
+            request = factory.get(url, {'cursor': page.previous_cursor})
+            request.user = AnonymousUser()
+            page = view(request, **kwargs).context_data['page_obj']
+            self.assertEqual([s.id for s in page], ids)
+        self.assertFalse(page.has_previous())
+
+    def test_invalid_cursor(self):
+        category = self.category_qs.first()
+        url = reverse('shop:category', args=[str(category.name).lower()])
+        response = self.client.get(url, {'cursor': 'invalid'}, secure=True)
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+    def test_facet_filter(self):
+        """Specs are filtered by the selected facets which have counts."""
+        document = SearchDocument.objects.filter(
+            specification__available_qty__gt=0,
+        ).exclude(attributes={}).select_related(
+            'category', 'parent_category',
+        ).first()
+        self.assertIsNotNone(document, msg='No specs with attributes.')
+        name, value = next(iter(document.attributes.items()))
+        category = document.parent_category or document.category
+        kwargs = {'category': str(category.name).lower()}
+        request = RequestFactory().get(
+            reverse('shop:category', kwargs=kwargs), {name: value},
+        )
+        request.user = AnonymousUser()
+        view = views.CategorySpecList.as_view(paginate_by=None)
+        context = view(request, **kwargs).context_data
+        spec_list = list(context['spec_list'])
+        self.assertIn(document.specification_id, [s.id for s in spec_list])
+        for spec in spec_list:
+            self.assertEqual(
+                spec.search_document.attributes.get(name), value,
+            )
+        facet = next(f for f in context['facets'] if f['name'] == name)
+        option = next(o for o in facet['options'] if o['value'] == value)
+        self.assertTrue(option['selected'])
+        self.assertEqual(option['count'], len(spec_list))
+        self.assertIn(urlencode({name: value}), context['url_keys'])
 
 
 class SubcategorySpecListTests(TestCase):
@@ -433,13 +596,7 @@ class CartViewTests(TestCase):
             order=self.cart_order, specification=spec,
             quantity=spec.pre_packing, price=spec.price,
         )
-        cart_aggr = self.cart_order.specs.annotate(
-            best_price=Case(
-                When(sale_price__gt=0, then=F('sale_price')),
-                When(discount__gt=0, then=F('discount_price')),
-                default=F('price'),
-            ),
-        ).aggregate(
+        cart_aggr = self.cart_order.specs.aggregate(
             order_cost=Sum('best_price'), item_count=Count('id'),
         )
         self.client.force_login(self.user)
@@ -452,6 +609,17 @@ class CartViewTests(TestCase):
         self.assertEqual(context['order'], self.cart_order)
         self.assertEqual(context['order_cost'], cart_aggr['order_cost'])
 
+    def test_get_empty_cart_page(self):
+        """The cost of an empty cart is not queried."""
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, secure=True)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.context['order'], self.cart_order)
+        self.assertEqual(response.context['num_in_cart'], 0)
+        self.assertEqual(response.context['order_cost'], 0)
+        self.assertFalse([q for q in queries if 'SUM(' in q['sql']])
+
 
 class CartItemFormViewTests(TestCase):
 
@@ -710,3 +878,144 @@ class AccountViewTests(TestCase):
         self.assertIn('cart', response.context_data)
         self.assertIn('catalog', response.context_data)
         self.assertEqual(response.context_data['cart'], num_in_cart)
+
+
+class ImageDerivativeViewTests(TestCase):
+
+    def setUp(self):
+        buffer = BytesIO()
+        Image.new('RGB', (600, 600)).save(buffer, 'JPEG')
+        self.name = default_storage.save(
+            'shop/test_image.jpg', ContentFile(buffer.getvalue()),
+        )
+        self.addCleanup(default_storage.delete, self.name)
+        self.addCleanup(shutil.rmtree, default_storage.path(
+            f'{services.DERIVATIVES_DIR}/{self.name}',
+        ), ignore_errors=True)
+
+    def get(self, width, fmt='webp', name=None):
+        return self.client.get(reverse('image_derivative', kwargs={
+            'name': name or self.name, 'width': width, 'fmt': fmt,
+        }))
+
+    def test_make_derivative(self):
+        """A derivative is made once and served from the media files."""
+        width = services.DERIVATIVE_WIDTHS[0]
+        response = self.get(width)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        with Image.open(BytesIO(b''.join(response.streaming_content))) as img:
+            self.assertEqual((img.format, img.size), ('WEBP', (width, width)))
+        path = default_storage.path(
+            services.get_derivative_name(self.name, width, 'webp'),
+        )
+        mtime = os.path.getmtime(path)
+        self.assertEqual(self.get(width).status_code, HTTPStatus.OK)
+        self.assertEqual(os.path.getmtime(path), mtime)
+
+    def test_srcset(self):
+        image = FieldFile(None, Specification._meta.get_field('image'),
+                          self.name)
+        srcset = services.get_image_srcset(image)
+        for width in services.DERIVATIVE_WIDTHS:
+            self.assertIn(f'{width}.webp {width}w', srcset)
+        image.name = f'shop/{services.PENDING_DIR}/test_image.jpg'
+        self.assertEqual(services.get_image_srcset(image), '')
+
+    def test_not_allowed_derivative(self):
+        for width, fmt in [(123, 'webp'), (services.DERIVATIVE_WIDTHS[0],
+                                           'bmp')]:
+            self.assertEqual(
+                self.get(width, fmt).status_code, HTTPStatus.NOT_FOUND,
+            )
+
+    def test_only_uploaded_images(self):
+        """Derivatives and files out of the upload directory are not found."""
+        width = services.DERIVATIVE_WIDTHS[0]
+        self.assertEqual(self.get(width).status_code, HTTPStatus.OK)
+        for name in [services.get_derivative_name(self.name, width, 'webp'),
+                     f'shop/../{self.name}', 'static/shop/placeholder.svg']:
+            with self.subTest(name):
+                self.assertEqual(
+                    self.get(width, name=name).status_code,
+                    HTTPStatus.NOT_FOUND,
+                )
+
+    def test_image_bomb(self):
+        with mock.patch('shop.services.MAX_IMAGE_PIXELS', 100):
+            response = self.get(services.DERIVATIVE_WIDTHS[0])
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+    def test_locked_derivative(self):
+        """While the derivative is made, the image is redirected to."""
+        width = services.DERIVATIVE_WIDTHS[0]
+        path = default_storage.path(
+            services.get_derivative_name(self.name, width, 'webp'),
+        )
+        os.makedirs(os.path.dirname(path))
+        open(f'{path}.lock', 'w').close()
+        response = self.get(width)
+        self.assertRedirects(response, default_storage.url(self.name),
+                             fetch_redirect_response=False)
+
+
+class ExportViewTests(TestCase):
+
+    fixtures = ['example_shop_data.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='staff', is_staff=True)
+        spec = Specification.objects.first()
+        for status in (Order.CART, Order.PROCESSING):
+            order = Order.objects.create(user=cls.user, status=status)
+            OrderItem.objects.create(
+                order=order, specification=spec, quantity=2,
+                price=spec.best_price,
+            )
+        cls.order = order
+
+    def get(self, name, fmt):
+        return self.client.get(reverse('shop:export', kwargs={
+            'name': name, 'fmt': fmt,
+        }))
+
+    def test_staff_only(self):
+        response = self.get('orders', 'csv')
+        self.assertEqual(response.status_code, HTTPStatus.FOUND)
+        self.client.force_login(User.objects.create_user(username='user'))
+        response = self.get('orders', 'csv')
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+        self.client.force_login(self.user)
+        self.assertEqual(self.get('users', 'csv').status_code,
+                         HTTPStatus.NOT_FOUND)
+        self.assertEqual(self.get('orders', 'xml').status_code,
+                         HTTPStatus.NOT_FOUND)
+
+    def test_export_specs(self):
+        """Specs are streamed with product fields as JSON lines."""
+        self.client.force_login(self.user)
+        response = self.get('specifications', 'jsonl')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['X-Accel-Buffering'], 'no')
+        rows = [json.loads(line) for line in
+                b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), Specification.objects.count())
+        spec = Specification.objects.order_by('pk').first()
+        self.assertEqual(rows[0]['id'], spec.pk)
+        self.assertEqual(rows[0]['product_name'], spec.content_object.name)
+
+    def test_export_orders(self):
+        """Items of placed orders are streamed as a gzipped CSV file."""
+        self.client.force_login(self.user)
+        response = self.get('orders', 'csv.gz')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('orders.csv.gz', response['Content-Disposition'])
+        content = gzip.decompress(b''.join(response.streaming_content))
+        rows = list(csv.DictReader(content.decode().splitlines()))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['order_id'], str(self.order.pk))
+        self.assertEqual(rows[0]['status'], 'Processing')
+        self.assertEqual(rows[0]['user'], 'staff')
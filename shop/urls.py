@@ -9,6 +9,8 @@ account_patterns = [
     path('', include('django.contrib.auth.urls')),
     path('cart/',
          views.CartView.as_view(), name='cart'),
+    path('csrf-token/',
+         views.CsrfTokenView.as_view(), name='csrf_token'),
     path('add-to-cart/',
          views.CartItemFormView.as_view(), name='add_to_cart'),
     path('orders/',
@@ -35,12 +37,19 @@ urlpatterns = [
     path('', views.HomePageView.as_view(), name='home'),
     path('account/', include(account_patterns)),
     path('search/', views.SearchView.as_view(), name='search'),
+    path('search/suggest/', views.SearchSuggestView.as_view(),
+         name='search_suggest'),
+    path('export/<slug:name>.<str:fmt>', views.ExportView.as_view(),
+         name='export'),
     path('<category>/',
-         views.CategorySpecList.as_view(), name='category'),
+         views.CategorySpecList.as_view(keyset_pagination=True),
+         name='category'),
     path('<category>/new/',
-         views.NewArrivalSpecList.as_view(), name='new'),
+         views.NewArrivalSpecList.as_view(keyset_pagination=True),
+         name='new'),
     path('<category>/popular/',
-         views.PopularSpecList.as_view(), name='popular'),
+         views.PopularSpecList.as_view(keyset_pagination=True),
+         name='popular'),
     path('<category>/<subcategory>/',
          views.SubcategorySpecList.as_view(), name='subcategory'),
     path('<category>/<subcategory>/<int:pk>/',
@@ -1,29 +1,58 @@
+import json
+import posixpath
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from decimal import Decimal
+from functools import reduce
+from http import HTTPStatus
+from PIL import Image
 
+from django.db import connections
 from django.db.models import (
     Prefetch, FilteredRelation, Q, Subquery, OuterRef, Exists,
-    Count, Avg, F, When, Case, prefetch_related_objects,
+    F, prefetch_related_objects,
 )
 from django.contrib import messages
-from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.mixins import (
+    LoginRequiredMixin, UserPassesTestMixin,
+)
 from django.contrib.auth.views import LoginView
 from django.contrib.auth.forms import (
     AuthenticationForm, SetPasswordForm,
 )
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.postgres.search import (
-    SearchQuery, SearchRank, SearchVector,
+from django.core.serializers.json import DjangoJSONEncoder
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseRedirect, JsonResponse,
+    StreamingHttpResponse,
 )
-from django.http import Http404, HttpResponseRedirect, JsonResponse
-from django.views.generic import TemplateView, FormView
+from django.middleware.csrf import get_token
+from django.template.defaultfilters import pluralize
+from django.views.generic import View, TemplateView, FormView
 from django.views.generic.edit import DeletionMixin
 from django.views.generic.list import MultipleObjectMixin
 from django.views.generic.detail import SingleObjectMixin
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
-
+from django.utils.cache import (
+    add_never_cache_headers, get_conditional_response, patch_cache_control,
+)
+from django.utils.functional import cached_property
+from django.utils.http import http_date, quote_etag, urlencode
+from django.utils.text import capfirst
+
+from .cache import (
+    PAGE_TIMEOUT, get_catalog, get_cart, get_facet_counts,
+    get_new_arrival_ids, get_page, get_page_validators, get_search_ids,
+    get_suggestions, normalize_search_terms, set_page,
+)
+from . import export, services
+from .services import PRODUCT_FIELDS
 from .models import (
-    Category, Specification, Rate, Order, OrderItem,
+    Category, Specification, Rate, RatingSummary, Order, OrderCost,
+    OrderItem,
 )
 from .forms import (CustomUserCreationForm, CustomUserChangeForm,
                     PartialOrderItemForm, PartialOrderForm,
@@ -43,9 +72,9 @@ class CreateAccountView(LoginView):
         return super().form_valid(form)
 
 
-def get_specs(queryset=None, ct_id=None):
+def get_specs(queryset=None, ct_id=None, product_fields=PRODUCT_FIELDS):
     """
-    Returns specification queryset with product prefetched,
+    Returns specification queryset with product loaded in a single query,
     filters if ContentType id of product model is passed.
     """
     queryset = queryset if queryset is not None else (
@@ -53,30 +82,288 @@ def get_specs(queryset=None, ct_id=None):
     )
     if ct_id is not None:
         queryset = queryset.filter(content_type_id=ct_id)
-    prefetch = Prefetch('content_object', to_attr='product')
     queryset = queryset.select_related(
         'category__category',
-    ).prefetch_related(prefetch)
+    ).with_products(product_fields)
     return queryset
 
 
 def get_specs_with_rating(queryset):
-    """Annotate specs objects with rating and number of rate"""
-    rates = Rate.objects.filter(
-        content_type_id=OuterRef('content_type_id'),
-        object_id=OuterRef('object_id'),
-    ).order_by().values('object_id')
+    """
+    Annotate specs objects with rating and number of rate,
+    joins the product rating summary table.
+    """
     queryset = queryset.annotate(
-        rating_avg=Subquery(
-            rates.annotate(Avg('point')).values('point__avg'),
-        ),
-        rating_count=Subquery(
-            rates.annotate(Count('user')).values('user__count'),
-        ),
+        rating_avg=F('rating__avg'), rating_count=F('rating__count'),
     )
     return queryset
 
 
+class KeysetPage:
+    """
+    Page of objects paginated by values of the ordering fields.
+
+    Provides cursors of the adjacent pages and an approximate number
+    of objects estimated by the database planner without counting.
+    """
+    def __init__(self, object_list, queryset, next_cursor=None,
+                 previous_cursor=None):
+        self.object_list = object_list
+        self.queryset = queryset
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @cached_property
+    def approximate_count(self) -> int:
+        queryset = self.queryset.order_by()
+        sql, params = queryset.query.sql_with_params()
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+class KeysetPaginationMixin:
+    """
+    Opt-in keyset pagination for views based on MultipleObjectMixin.
+
+    The page is selected by the values of the ordering fields and
+    id of the first or last object of the adjacent page, passed in
+    an opaque cursor instead of a page number, so any page costs
+    the same as the first one. Ordering fields must be not null.
+    """
+    keyset_pagination = False
+    cursor_kwarg = 'cursor'
+
+    def get_keyset_ordering(self) -> tuple:
+        """Returns the view ordering with id as a tiebreaker."""
+        ordering = tuple(self.get_ordering() or ())
+        if not {'id', 'pk'} & {f.lstrip('-') for f in ordering}:
+            ordering += ('id',)
+        return ordering
+
+    @staticmethod
+    def encode_cursor(direction, values) -> str:
+        data = json.dumps([direction, values], cls=DjangoJSONEncoder)
+        return urlsafe_b64encode(data.encode()).decode()
+
+    def decode_cursor(self):
+        """Returns the page direction and ordering values from the cursor."""
+        cursor = self.request.GET.get(self.cursor_kwarg)
+        if not cursor:
+            return 'next', None
+        try:
+            direction, values = json.loads(urlsafe_b64decode(cursor))
+        except (ValueError, TypeError):
+            raise Http404('Invalid cursor.')
+        if direction not in ('next', 'prev') or not isinstance(values, list):
+            raise Http404('Invalid cursor.')
+        return direction, values
+
+    @staticmethod
+    def get_keyset_values(obj, ordering) -> list:
+        return [reduce(getattr, f.lstrip('-').split('__'), obj) for
+                f in ordering]
+
+    @staticmethod
+    def get_keyset_q(ordering, values, direction) -> Q:
+        """
+        Returns a condition for objects after the values in the
+        ordering or before them if the direction is prev.
+        """
+        q, equal = Q(), {}
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            is_after = field.startswith('-') == (direction == 'prev')
+            lookup = f'{name}__{"gt" if is_after else "lt"}'
+            q |= Q(**equal, **{lookup: value})
+            equal[name] = value
+        return q
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.keyset_pagination:
+            return super().paginate_queryset(queryset, page_size)
+        ordering = self.get_keyset_ordering()
+        direction, values = self.decode_cursor()
+        object_list = queryset
+        if values is not None:
+            if len(values) != len(ordering):
+                raise Http404('Invalid cursor.')
+            q = self.get_keyset_q(ordering, values, direction)
+            object_list = queryset.filter(q)
+        if direction == 'prev':
+            object_list = object_list.order_by(*(
+                f[1:] if f.startswith('-') else f'-{f}' for f in ordering
+            ))
+        else:
+            object_list = object_list.order_by(*ordering)
+        object_list = list(object_list[:page_size + 1])
+        has_more = len(object_list) > page_size
+        object_list = object_list[:page_size]
+        if direction == 'prev':
+            object_list.reverse()
+        next_cursor = previous_cursor = None
+        if object_list:
+            if has_more or direction == 'prev':
+                values_last = self.get_keyset_values(object_list[-1], ordering)
+                next_cursor = self.encode_cursor('next', values_last)
+            if values is not None and (has_more or direction == 'next'):
+                values_first = self.get_keyset_values(object_list[0], ordering)
+                previous_cursor = self.encode_cursor('prev', values_first)
+        page = KeysetPage(object_list, queryset, next_cursor, previous_cursor)
+        return None, page, page.object_list, page.has_other_pages()
+
+
+class AnonymousPageCacheMixin:
+    """
+    Serves pages to anonymous users from the cache.
+
+    Pages are cached by the path and the query string until the
+    catalog is changed. Forms of cached pages contain a placeholder
+    instead of the CSRF token, the token of a visitor is fetched
+    from the csrf_token view by the page script.
+
+    Responses are validated by the ETag and Last-Modified headers
+    derived from the catalog version and the current page_timeout
+    window, so a conditional request is answered with 304 without
+    rendering the page. The nginx proxy keeps pages for page_timeout
+    seconds and revalidates them, ignoring Vary: Cookie added when
+    the user is read from the session.
+    """
+    csrf_token_placeholder = 'csrf-token-placeholder'
+    page_timeout = PAGE_TIMEOUT
+
+    def is_page_cached(self, request) -> bool:
+        return (request.method in ('GET', 'HEAD') and
+                not request.user.is_authenticated)
+
+    def dispatch(self, request, *args, **kwargs):
+        if not self.is_page_cached(request):
+            return super().dispatch(request, *args, **kwargs)
+        etag, last_modified = get_page_validators(request)
+        if etag is None:
+            return self.get_page_response(request, *args, **kwargs)
+        etag = quote_etag(etag)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified,
+        )
+        if response is None:
+            response = self.get_page_response(request, *args, **kwargs)
+        if response.status_code in (HTTPStatus.OK, HTTPStatus.NOT_MODIFIED):
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            response['X-Accel-Expires'] = self.page_timeout
+            patch_cache_control(response, max_age=0)
+        return response
+
+    def get_page_response(self, request, *args, **kwargs):
+        """Returns the cached page or renders and caches it."""
+        page = get_page(request)
+        if page is not None:
+            return HttpResponse(**page)
+        self.extra_context = {
+            **(self.extra_context or {}),
+            'csrf_token': self.csrf_token_placeholder,
+        }
+        response = super().dispatch(request, *args, **kwargs)
+        if (response.status_code == HTTPStatus.OK and
+                hasattr(response, 'add_post_render_callback')):
+            response.add_post_render_callback(
+                lambda r: set_page(request, r),
+            )
+        return response
+
+
+class CsrfTokenView(View):
+    """Returns the CSRF token of a visitor for forms of cached pages."""
+
+    def get(self, request, *args, **kwargs):
+        response = JsonResponse({'token': get_token(request)})
+        add_never_cache_headers(response)
+        return response
+
+
+class ImageDerivativeView(View):
+    """
+    Makes a resized copy of a media image on the first request,
+    later requests for it are served by nginx from the media files.
+
+    Redirects to the image while another process makes the copy.
+    Copies are made only of images uploaded to the app directory.
+    """
+    upload_dir = f'{Specification._meta.app_label}/'
+
+    def get(self, request, name, width, fmt, *args, **kwargs):
+        if (width not in services.DERIVATIVE_WIDTHS or
+                fmt not in services.DERIVATIVE_FORMATS or
+                posixpath.normpath(name) != name or
+                not name.startswith(self.upload_dir) or
+                name.startswith(f'{services.DERIVATIVES_DIR}/') or
+                services.is_image_pending(name)):
+            raise Http404('No image derivative found.')
+        try:
+            path = services.make_image_derivative(
+                default_storage, name, width, fmt,
+            )
+        except (OSError, SuspiciousFileOperation,
+                Image.DecompressionBombError):
+            raise Http404('No image derivative found.')
+        if path is None:
+            return HttpResponseRedirect(default_storage.url(name))
+        response = FileResponse(open(path, 'rb'),
+                                content_type=f'image/{fmt}')
+        patch_cache_control(response, public=True, max_age=60 * 60 * 24)
+        return response
+
+
+class ExportView(UserPassesTestMixin, View):
+    """
+    Streams specifications or orders to staff as a CSV or JSON lines
+    file, compressed with gzip if the name ends with .gz.
+
+    Rows are read with a server-side cursor and sent as they are read.
+    """
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request, name, fmt, *args, **kwargs):
+        file_format, _, compression = fmt.partition('.')
+        if (name not in export.EXPORTS or
+                file_format not in export.FORMATS or
+                compression not in ('', 'gz')):
+            raise Http404('No export found.')
+        iter_rows, columns = export.EXPORTS[name]
+        response = StreamingHttpResponse(
+            export.iter_export(iter_rows(), columns, file_format,
+                               compress=bool(compression)),
+            content_type=('application/gzip' if compression else
+                          export.CONTENT_TYPES[file_format]),
+        )
+        response['Content-Disposition'] = (
+            f'attachment; filename="{name}.{fmt}"'
+        )
+        # nginx passes the chunks on without buffering the response
+        response['X-Accel-Buffering'] = 'no'
+        add_never_cache_headers(response)
+        return response
+
+
 class ShopView(TemplateView):
     """
     Base class for views, which displays products.
@@ -117,9 +404,7 @@ class ShopView(TemplateView):
         display rating stars, and unbound forms if needed.
         """
         context = super().get_context_data(**kwargs)
-        context['catalog'] = self.categories.filter(
-            category__isnull=True,
-        )
+        context['catalog'] = get_catalog()
         context['form_rating'] = PartialRatingForm(auto_id=False)
         context['form'] = PartialOrderItemForm(auto_id=False)
         if not self.request.user.is_authenticated:
@@ -130,12 +415,11 @@ class ShopView(TemplateView):
                 auto_id='sign_up_%s', label_suffix='',
             )
         elif 'cart' not in kwargs:
-            context['cart'] = {obj.specification_id: obj.quantity for
-                               obj in self.get_cart_items()}
+            context['cart'] = get_cart(self.request.user.id)
         return context
 
 
-class HomePageView(ShopView):
+class HomePageView(AnonymousPageCacheMixin, ShopView):
     """
     Display the latest products on the home page.
     """
@@ -150,12 +434,14 @@ class HomePageView(ShopView):
         return context
 
 
-class SearchView(MultipleObjectMixin, ShopView):
+class SearchView(AnonymousPageCacheMixin, MultipleObjectMixin, ShopView):
     """
     Display the paginated list of products for a search query.
 
-    Uses full-text search, first searches for matches in category names
-    to narrow down the search, then for all product models.
+    Uses full-text search in the spec search documents, if the query
+    matches a category name, the search is narrowed down to the best
+    matching category and its subcategories. Ranked spec ids are cached
+    by the normalized query and only the specs of a page are loaded.
     """
     template_name = 'shop/search.html'
     context_object_name = 'spec_list'
@@ -166,89 +452,21 @@ class SearchView(MultipleObjectMixin, ShopView):
     object_list = None
     paginate_by = 20
 
-    @staticmethod
-    def get_category_vector() -> SearchVector:
-        return SearchVector('name', config='english')
-
-    @staticmethod
-    def get_specs_vector() -> SearchVector:
-        return SearchVector('tag', config='english')
-
-    @staticmethod
-    def get_products_vector() -> SearchVector:
-        return SearchVector('name', 'marking', config='english')
-
     def get_category_search_rank(self):
         """Rank and filter category by search text"""
         query = self.query
-        vector = self.get_category_vector()
-        qs = self.categories.annotate(search=vector).filter(search=query)
-        return qs.annotate(rank=SearchRank(vector, query))
-
-    def get_products_search(self, ct_obj: ContentType):
-        """Filter products by search text"""
-        vector = self.get_products_vector()
-        model = ct_obj.model_class()
-        qs = model.objects.annotate(search=vector).filter(search=self.query)
-        return qs
-
-    def get_specs_search_rank(self, ct_obj: ContentType, cat_list=None):
-        """Rank and filter specifications by search text"""
-        query = self.query
-        vector = self.get_specs_vector()
-        qs_prod = self.get_products_search(ct_obj)
-        product = qs_prod.filter(id=OuterRef('object_id'))
-        product_rank = product.annotate(rank=SearchRank('search', query))
-        qs = get_specs(ct_id=ct_obj.id).annotate(search=vector)
-        if cat_list is None:
-            qs = qs.filter(Q(Exists(product)) | Q(search=query))
-        else:
-            qs = qs.filter(category_id__in=cat_list)
-        qs = qs.annotate(
-            rank_prod=Subquery(product_rank.order_by().values('rank')),
-            rank_spec=SearchRank('search', query),
-        ).annotate(rank=Case(
-            When(rank_prod__isnull=True, then='rank_spec'),
-            default=(F('rank_prod') + F('rank_spec')),
-        ))
-        return get_specs_with_rating(qs)
-
-    def search_in_category(self, category):
-        """Search the query text in a specific category."""
-        ct_obj = category.content_type
-        cat_list = [category.id] + [c.id for c in category.subcategories]
-        qs = self.get_specs_search_rank(ct_obj, cat_list=cat_list)
-        for sub in category.subcategories:
-            if sub.content_type_id != category.content_type_id:
-                qs_other = self.get_specs_search_rank(
-                    sub.content_type, cat_list=cat_list,
-                )
-                qs = qs.union(qs_other)
-        return qs
-
-    def search_in_products(self):
-        """Search the query text in all product models"""
-        ct_list = list(ContentType.objects.filter(model__iendswith='product'))
-        search_list = [
-            ct for ct in ct_list if self.get_products_search(ct).exists()
-        ]
-        if not search_list:
-            id_list = Specification.objects.annotate(
-                search=self.get_specs_vector()
-            ).filter(search=self.query).order_by().distinct(
-                'content_type_id'
-            ).values_list(
-                'content_type_id', flat=True
-            )
-            search_list = [ContentType.objects.get_for_id(i) for i in id_list]
-        if search_list:
-            ct_obj = search_list.pop()
-            qs = self.get_specs_search_rank(ct_obj)
-            for obj in search_list:
-                qs = qs.union(self.get_specs_search_rank(obj))
-        else:
-            qs = self.get_specs_search_rank(ct_list[0]).none()
-        return qs
+        qs = Category.objects.filter(search_vector=query)
+        return qs.annotate(rank=SearchRank(F('search_vector'), query))
+
+    def get_category_filter(self) -> Q:
+        """Returns a filter of specs by the best matching category
+        if there is one, evaluated in the search query."""
+        category = self.get_category_search_rank().order_by(
+            '-rank', 'id',
+        ).values('id')[:1]
+        return (Q(search_document__category_id=Subquery(category)) |
+                Q(search_document__parent_category_id=Subquery(category)) |
+                ~Q(Exists(category)))
 
     def get_queryset(self):
         if not self.q:
@@ -258,19 +476,31 @@ class SearchView(MultipleObjectMixin, ShopView):
         for s in self.q[1:]:
             query |= SearchQuery(s)
         self.query = query
-        category_qs = self.get_category_search_rank()
-        try:
-            category = category_qs.order_by('-rank')[0]
-        except IndexError:
-            qs = self.search_in_products()
-        else:
-            qs = self.search_in_category(category)
-        return qs.order_by(*ordering)[:self.num_obj]
+        qs = get_specs().filter(
+            self.get_category_filter(), search_document__search_vector=query,
+        ).annotate(
+            rank=SearchRank(F('search_document__search_vector'), query),
+            rating_avg=F('search_document__rating_avg'),
+            rating_count=F('search_document__rating_count'),
+        )
+        return qs.order_by(*ordering, 'id')[:self.num_obj]
+
+    def paginate_queryset(self, queryset, page_size):
+        """Paginates the list of spec ids, then loads specs
+        of the page in the same order."""
+        paginator, page, id_list, is_paginated = super().paginate_queryset(
+            queryset, page_size,
+        )
+        specs = get_specs_with_rating(get_specs()).in_bulk(id_list)
+        page.object_list = [specs[i] for i in id_list if i in specs]
+        return paginator, page, page.object_list, is_paginated
 
     def get_context_data(self, **kwargs):
         q_string = self.request.GET.get('q', '')
         self.q = q_string.split()
-        self.object_list = self.get_queryset()
+        self.object_list = get_search_ids(
+            normalize_search_terms(q_string), self.get_queryset(),
+        ) if self.q else []
         context = super().get_context_data(**kwargs)
         context.update({
             'q': q_string, 'url_keys': f'&q={"+".join(self.q)}',
@@ -279,13 +509,132 @@ class SearchView(MultipleObjectMixin, ShopView):
         return context
 
 
-class CategorySpecList(MultipleObjectMixin, ShopView):
+class SearchSuggestView(View):
+    """
+    Returns json with the categories and products matching
+    the text typed in the search box.
+    """
+    min_length = 2
+    max_length = 100
+
+    def get(self, request, *args, **kwargs):
+        q = request.GET.get('q', '').strip()[:self.max_length]
+        if len(q) < self.min_length:
+            return JsonResponse({'categories': [], 'specs': []})
+        return JsonResponse(get_suggestions(q))
+
+
+class FacetFilterMixin:
+    """
+    Filters specs of a category by price range, rating, discount and
+    product attributes, provides the facets with cached counts.
+    """
+    price_limits = (50, 100, 500, 1000)
+    rating_limits = (4, 3, 2, 1)
+
+    @staticmethod
+    def get_attribute_fields(category) -> dict:
+        """Returns facet fields of the category product models by name."""
+        content_types = {category.content_type_id} | {
+            c.content_type_id for c in getattr(category, 'subcategories', ())
+        }
+        fields = {}
+        for ct_id in sorted(content_types):
+            model = ContentType.objects.get_for_id(ct_id).model_class()
+            for name in getattr(model, 'FACET_FIELDS', ()):
+                fields[name] = model._meta.get_field(name)
+        return fields
+
+    def get_int_params(self, name) -> list:
+        return [int(v) for v in self.request.GET.getlist(name) if v.isdigit()]
+
+    def get_price_range(self, num) -> tuple:
+        limits = (None, *self.price_limits, None)
+        return limits[num], limits[num + 1]
+
+    def get_facet_q(self, category) -> Q:
+        """Returns a condition for specs matching the selected facets."""
+        params, q = self.request.GET, Q()
+        price_q = Q()
+        for num in self.get_int_params('price'):
+            if num <= len(self.price_limits):
+                lower, upper = self.get_price_range(num)
+                price_q |= Q(best_price__gte=lower or 0, **(
+                    {'best_price__lt': upper} if upper else {}
+                ))
+        q &= price_q
+        if rating := self.get_int_params('rating'):
+            q &= Q(rating__avg__gte=max(rating))
+        if params.get('discount'):
+            q &= Q(best_price__lt=F('price'))
+        for name in self.get_attribute_fields(category):
+            values_q = Q()
+            for value in params.getlist(name):
+                values_q |= Q(search_document__attributes__contains={
+                    name: value,
+                })
+            q &= values_q
+        return q
+
+    def get_facet_params(self, category) -> list:
+        names = ['price', 'rating', 'discount',
+                 *self.get_attribute_fields(category)]
+        return [(n, v) for n in names for v in self.request.GET.getlist(n)]
+
+    def get_facets(self, category) -> list:
+        """Returns facets with options, their counts and selection."""
+        counts = get_facet_counts(category, self.price_limits)
+        selected = self.get_facet_params(category)
+
+        def option(name, value, label, count):
+            return {'value': value, 'label': label, 'count': count,
+                    'selected': (name, str(value)) in selected}
+
+        price_options = []
+        for num, count in sorted(counts['price'].items()):
+            lower, upper = self.get_price_range(num)
+            label = (f'${lower} - ${upper}' if lower and upper else
+                     f'Under ${upper}' if upper else f'${lower} & above')
+            price_options.append(option('price', num, label, count))
+        rating_options = [
+            option('rating', limit, f'{limit} & up', sum(
+                n for r, n in counts['rating'].items() if r >= limit
+            )) for limit in self.rating_limits
+        ]
+        facets = [
+            {'name': 'price', 'label': 'Price', 'options': price_options},
+            {'name': 'rating', 'label': 'Rating', 'options': [
+                o for o in rating_options if o['count']
+            ]},
+            {'name': 'discount', 'label': 'Discount', 'options': [
+                option('discount', 1, 'On sale', counts['discount']),
+            ] if counts['discount'] else []},
+        ]
+        for name, field in self.get_attribute_fields(category).items():
+            choices = dict(field.flatchoices)
+            facets.append({
+                'name': name, 'label': capfirst(field.verbose_name),
+                'options': [
+                    option(name, value, choices.get(value, value), count)
+                    for value, count in sorted(
+                        counts['attributes'].get(name, {}).items()
+                    )
+                ],
+            })
+        return [f for f in facets if f['options']]
+
+
+class CategorySpecList(AnonymousPageCacheMixin, FacetFilterMixin,
+                       KeysetPaginationMixin, MultipleObjectMixin, ShopView):
     """
     Display a paginated list of products for the selected category.
+
+    Specs are grouped by the category id, so the price index returns
+    them in the order for category_id IN (...) without a sort.
     """
     template_name = 'shop/specs_by_category.html'
     context_object_name = 'spec_list'
-    ordering = ('category__name', 'price')
+    ordering = ('category_id', 'best_price')
     paginate_by = 2
     object_list = None
 
@@ -306,35 +655,45 @@ class CategorySpecList(MultipleObjectMixin, ShopView):
 
         Object of the specification has the attribute
         product to which it belongs.
-        Queryset for different product type are combined.
+        Specs of the category and its subcategories are selected by
+        category id in a single query whatever their product types.
         """
         ordering = self.get_ordering()
         category = self.get_category()
         self.kwargs['category'] = category
-        ct_id = category.content_type_id
-        queryset = get_specs(queryset=self.queryset, ct_id=ct_id)
-        if not category.subcategories:
-            queryset = queryset.filter(category_id=category.id)
-            queryset = get_specs_with_rating(queryset)
-            return queryset.order_by(*ordering)
-        queryset = get_specs_with_rating(queryset)
-        for sub in category.subcategories:
-            if sub.content_type_id != ct_id:
-                qs = get_specs(self.queryset, sub.content_type_id)
-                qs = get_specs_with_rating(qs)
-                queryset = queryset.union(qs)
+        queryset = get_specs(queryset=self.get_category_specs(category))
+        queryset = get_specs_with_rating(queryset.filter(
+            self.get_facet_q(category),
+        ))
         return queryset.order_by(*ordering)
 
+    def get_category_specs(self, category):
+        """Returns specs of the category and its subcategories."""
+        category_ids = [category.id, *(
+            sub.id for sub in getattr(category, 'subcategories', ())
+        )]
+        queryset = self.queryset if self.queryset is not None else (
+            Specification.objects.filter(available_qty__gt=0)
+        )
+        return queryset.filter(category_id__in=category_ids)
+
     def get_context_data(self, **kwargs):
         self.object_list = self.get_queryset()
         context = super().get_context_data(**kwargs)
-        context['category'] = self.kwargs['category']
+        category = self.kwargs['category']
+        context.update({
+            'category': category,
+            'facets': self.get_facets(category),
+            'url_keys': ''.join(
+                f'&{urlencode([p])}' for p in self.get_facet_params(category)
+            ),
+        })
         return context
 
 
 class SubcategorySpecList(CategorySpecList):
 
-    ordering = ('price',)
+    ordering = ('best_price',)
 
     def get_category(self):
         category = self.categories.filter(
@@ -350,21 +709,31 @@ class SubcategorySpecList(CategorySpecList):
 class NewArrivalSpecList(CategorySpecList):
 
     ordering = ('-date_added',)
-    new_date = timezone.now().date() - timezone.timedelta(days=14)
-    queryset = Specification.objects.filter(
-        date_added__gte=new_date, available_qty__gt=0,
-    )
+    new_arrival_days = 14
+
+    def get_new_date(self):
+        """Returns the first date of the new arrivals window."""
+        return timezone.localdate() - timezone.timedelta(
+            days=self.new_arrival_days,
+        )
+
+    def get_category_specs(self, category):
+        return Specification.objects.filter(
+            id__in=get_new_arrival_ids(category, self.get_new_date()),
+            available_qty__gt=0,
+        )
 
 
 class PopularSpecList(CategorySpecList):
 
-    ordering = ('-num_orders',)
+    ordering = ('-popularity',)
     queryset = Specification.objects.filter(
-        available_qty__gt=0,
-    ).annotate(num_orders=Count('order')).filter(num_orders__gt=0)
+        available_qty__gt=0, num_orders__gt=0,
+    )
 
 
-class SpecificationDetail(SingleObjectMixin, ShopView):
+class SpecificationDetail(AnonymousPageCacheMixin, SingleObjectMixin,
+                          ShopView):
     """
     Display product details, uses a custom template
     for different ContentTypes.
@@ -393,6 +762,7 @@ class SpecificationDetail(SingleObjectMixin, ShopView):
     def get_queryset(self):
         queryset = get_specs(
             queryset=Specification.objects.filter(pk=self.kwargs['pk']),
+            product_fields=None,
         )
         if self.request.user.is_authenticated:
             rates = Rate.objects.filter(
@@ -434,16 +804,9 @@ class CartView(LoginRequiredMixin, ShopView):
             total_price=F('price') * F('quantity'),
         ).select_related('order').order_by('-id'))
         if item_list:
-            price_case = Case(
-                When(sale_price__gt=0, then=F('sale_price')),
-                When(discount__gt=0, then=F('discount_price')),
-                default=F('price'),
-            )
-            spec_queryset = Specification.objects.annotate(
-                best_price=price_case,
-            ).select_related('category__category').prefetch_related(
-                Prefetch('content_object', to_attr='product'),
-            )
+            spec_queryset = get_specs(Specification.objects.with_free_qty(
+                exclude_order=item_list[0].order_id,
+            ))
             spec_prefetch = Prefetch(
                 'specification', queryset=spec_queryset, to_attr='spec',
             )
@@ -458,24 +821,29 @@ class CartView(LoginRequiredMixin, ShopView):
         and calculate the cost of the order.
         """
         item_list = self.get_cart_items_with_specs()
-        num_in_cart, order_cost = 0, Decimal('0.00')
+        if item_list:
+            order = item_list[0].order
+            cost = order.get_cost()
+        else:
+            order = Order.objects.filter(
+                user=self.request.user, status=Order.CART,
+            ).first()
+            zero = Decimal('0.00')
+            cost = OrderCost(current=zero, stored=zero, num_items=0,
+                             drifted_specs=[])
         msg = 'Some items have changed in price or available qty.'
         for item in item_list:
-            if item.quantity > item.spec.available_qty:
-                item.error_msg = (f'{item.spec.available_qty.normalize()} '
-                                  f'in stock.')
+            free_qty = max(item.spec.free_qty, Decimal('0'))
+            if item.quantity > free_qty:
+                item.error_msg = f'{free_qty.normalize()} in stock.'
                 kwargs['error_msg'] = msg
-            elif item.price != item.spec.best_price:
+            elif item.specification_id in cost.drifted_specs:
                 item.error_msg = 're-add to cart or update quantity.'
                 kwargs['error_msg'] = msg
-            order_cost += item.total_price
-            num_in_cart += 1
-        kwargs.update({'order_cost': order_cost.quantize(Decimal('0.00')),
-                       'num_in_cart': num_in_cart, 'cart': item_list})
+        kwargs.update({'order_cost': cost.stored,
+                       'num_in_cart': cost.num_items, 'cart': item_list})
         context = super().get_context_data(**kwargs)
-        context['order'] = Order.objects.filter(
-                user=self.request.user, status=Order.CART,
-        ).first()
+        context['order'] = order
         context['messages'] = messages.get_messages(self.request)
         return context
 
@@ -515,13 +883,8 @@ class CartItemFormView(LoginRequiredMixin, FormView):
         return kwargs
 
     def get_success_json_response(self, obj):
-        num_in_cart = OrderItem.objects.annotate(
-            user_orders=FilteredRelation(
-                'order', condition=Q(order__user_id=self.request.user.id),
-            ),
-        ).filter(user_orders__status=Order.CART).count()
         context = {
-            'num_in_cart': num_in_cart,
+            'num_in_cart': len(get_cart(self.request.user.id)),
             "success": ("The quantity of the item has changed." if
                         obj.quantity else "Item removed from cart."),
         }
@@ -553,16 +916,9 @@ class AccountView(LoginRequiredMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        cart_num = OrderItem.objects.annotate(
-            user_orders=FilteredRelation(
-                'order', condition=Q(order__user_id=self.request.user.id),
-            ),
-        ).filter(user_orders__status=Order.CART).count()
-        catalog = Category.objects.prefetch_related(
-            Prefetch('categories', to_attr='subcategories'),
-        ).filter(category__isnull=True)
         context.update({
-            'cart': cart_num, 'catalog': catalog,
+            'cart': len(get_cart(self.request.user.id)),
+            'catalog': get_catalog(),
             'messages': messages.get_messages(self.request),
         })
         return context
@@ -599,8 +955,10 @@ class PlaceOrderView(AccountView):
                 messages.error(request, msg, extra_tags='danger')
                 return HttpResponseRedirect(reverse("shop:cart"))
         if form.has_error('order_cost', code='price'):
-            messages.error(request, 'Some items have changed in price',
-                           extra_tags='danger')
+            num = len(form.cost.drifted_specs)
+            msg = (f'{num} item{pluralize(num)} changed in price' if num else
+                   'Some items have changed in price')
+            messages.error(request, msg, extra_tags='danger')
             return HttpResponseRedirect(reverse("shop:cart"))
         else:
             for error in form.errors.values():
@@ -640,11 +998,7 @@ class OrderDetailView(SingleObjectMixin, AccountView):
 
     def get(self, request, *args, **kwargs):
         self.object = self.get_object()
-        spec_queryset = Specification.objects.select_related(
-            'category__category',
-        ).prefetch_related(
-            Prefetch('content_object', to_attr='product'),
-        )
+        spec_queryset = get_specs(Specification.objects.all())
         spec_prefetch = Prefetch(
             'specification', queryset=spec_queryset, to_attr='spec',
         )
@@ -765,7 +1119,7 @@ class RatingListView(MultipleObjectMixin, AccountView):
         ordering = self.get_ordering()
         queryset = Rate.objects.filter(
             user_id=self.request.user.id,
-        ).prefetch_related(Prefetch('content_object', to_attr='product'))
+        ).with_products()
         return queryset.order_by(*ordering)
 
     def get_context_data(self, **kwargs):
@@ -793,12 +1147,9 @@ class RatingFormView(CartItemFormView):
         return Rate(user=self.request.user)
 
     def get_success_json_response(self, obj):
-        context = Rate.objects.filter(
+        context = RatingSummary.objects.filter(
             content_type_id=obj.content_type_id,
             object_id=obj.object_id,
-        ).aggregate(
-            rating_avg=Avg('point'),
-            rating_count=Count('user'),
-        )
+        ).values(rating_avg=F('avg'), rating_count=F('count')).get()
         context['success'] = 'Rating saved.'
         return JsonResponse(context, status=200)